@@ -13,12 +13,16 @@ and more than 40,000 retailers in the region.
     'website': "https://tabby.ai",
     'depends': ['website', 'sale', 'website_sale', 'payment'],
     'data': [
+        'security/ir.model.access.csv',
+
         'views/payment_provider_views.xml',
         'views/payment_tabby_templates.xml',
         'views/tabby_promo_templates.xml',
         'views/payment_redirect_form.xml',
+        'views/payment_transaction_views.xml',
         
         'data/ir_cron_data.xml',
+        'data/ir_actions_server_data.xml',
 
         'data/payment_method_data.xml',
         'data/payment_provider_data.xml',        
@@ -0,0 +1,178 @@
+""" End-to-end load test of the Tabby checkout against the local API stand-in.
+
+Prepares Tabby transactions by creating real sessions on the stand-in (see
+`standin.py`), then calls the `/payment/tabby/*` routes of a running Odoo
+server with a fixed concurrency and reports the throughput and the p50, p95
+and p99 latencies of the session creation and of the routes.
+
+Start the Odoo server to test, then run the driver from an Odoo shell on the
+same database::
+
+    $ odoo-bin shell -d tabby_bench --no-http <<< \\
+        "from odoo.addons.payment_tabby.benchmarks import load; load.run(env, scenario='webhook')"
+
+The scenarios are `success`, `webhook`, `cancel` and `failure`. The created
+records are kept; use a scratch database.
+"""
+import json
+import math
+import time
+import urllib.error
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo.fields import Command
+
+from . import standin
+
+SCENARIOS = ('success', 'webhook', 'cancel', 'failure')
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def percentile(samples, rank):
+    """ Return the nearest-rank percentile of the samples. """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(rank / 100 * len(ordered)) - 1, 0)]
+
+
+def report(name, samples, elapsed, errors=0):
+    throughput = len(samples) / elapsed if elapsed else 0.0
+    print(
+        f"{name:<16} n={len(samples):<6} errors={errors:<5} {throughput:>8.1f} req/s  "
+        f"p50={percentile(samples, 50) * 1000:.1f}ms  p95={percentile(samples, 95) * 1000:.1f}ms  "
+        f"p99={percentile(samples, 99) * 1000:.1f}ms"
+    )
+
+
+def run(env, odoo_url='http://localhost:8069', standin_url=None, transactions=200, concurrency=20,
+        scenario='success', webhook_secret=None, **standin_options):
+    """ Run one load test scenario and print its report.
+
+    :param env: An environment on the database served at `odoo_url`.
+    :param str odoo_url: The base url of the Odoo server under test.
+    :param str standin_url: The base url of a running stand-in; one is started
+                            in this process with `standin_options` if not given.
+    :param int transactions: The number of checkouts to simulate.
+    :param int concurrency: The number of concurrent clients calling Odoo.
+    :param str scenario: The route to load, one of `SCENARIOS`.
+    :param str webhook_secret: The webhook secret of the provider, sent with the webhooks.
+    """
+    assert scenario in SCENARIOS, f"Unknown scenario {scenario}"
+    env = env(su=True)
+    server = None
+    if not standin_url:
+        server = standin.serve(port=0, **standin_options)
+        standin_url = server.state.base_url
+
+    ICP = env['ir.config_parameter']
+    previous_base_url = ICP.get_param('payment_tabby.api_base_url')
+    ICP.set_param('payment_tabby.api_base_url', f"{standin_url}/api/")
+    env.cr.commit()
+    try:
+        payments = _prepare_transactions(env, transactions, concurrency)
+        if scenario in ('success', 'webhook'):
+            for payment_id in payments:
+                _call('POST', f"{standin_url}/_standin/payments/{payment_id}/authorize", {})
+
+        provider = env.ref('payment_tabby.payment_provider_tabby')
+        header = provider.tabby_webhook_auth_header
+
+        def call(payment_id):
+            if scenario == 'webhook':
+                payment = _call('GET', f"{standin_url}/api/v2/payments/{payment_id}")
+                body = dict(payment, status=payment['status'].lower())
+                headers = {header: webhook_secret} if webhook_secret else {}
+                return _timed('POST', f"{odoo_url}/payment/tabby/webhook", body, headers)
+            return _timed('GET', f"{odoo_url}/payment/tabby/{scenario}?payment_id={payment_id}")
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(call, payments))
+        elapsed = time.perf_counter() - start
+        report(f"/{scenario}", [t for t, ok in results if ok], elapsed, errors=sum(not ok for t, ok in results))
+    finally:
+        ICP.set_param('payment_tabby.api_base_url', previous_base_url or False)
+        env.cr.commit()
+        if server:
+            server.shutdown()
+
+
+def _prepare_transactions(env, count, concurrency):
+    """ Create `count` orders and their Tabby sessions, and return the Tabby payment ids. """
+    provider = env.ref('payment_tabby.payment_provider_tabby')
+    if provider.state == 'disabled':
+        provider.state = 'test'
+    currency = env.ref('base.AED')
+    currency.active = True
+    pricelist = env['product.pricelist'].create({'name': "Tabby Load Test", 'currency_id': currency.id})
+    product = env['product.product'].create({'name': "Tabby Load Test Product", 'list_price': 250})
+    partner = env['res.partner'].create({
+        'name': "Tabby Load Test Buyer",
+        'email': 'tabby.load@example.com',
+        'phone': '+971500000000',
+        'city': "Dubai",
+        'country_id': env.ref('base.ae').id,
+    })
+    orders = env['sale.order'].create([{
+        'partner_id': partner.id,
+        'pricelist_id': pricelist.id,
+        'order_line': [Command.create({'product_id': product.id, 'product_uom_qty': 1})],
+    } for _i in range(count)])
+    txs = env['payment.transaction'].create([{
+        'provider_id': provider.id,
+        'payment_method_id': env.ref('payment_tabby.payment_method_tabby_installments').id,
+        'amount': order.amount_total,
+        'currency_id': currency.id,
+        'partner_id': partner.id,
+        'sale_order_ids': [Command.set(order.ids)],
+    } for order in orders])
+    env.cr.commit()
+
+    samples = []
+    start = time.perf_counter()
+    for tx in txs:
+        tx_start = time.perf_counter()
+        tx._get_specific_rendering_values({})
+        samples.append(time.perf_counter() - tx_start)
+    report('createSession', samples, time.perf_counter() - start, errors=len(txs.filtered(lambda t: t.state == 'error')))
+    env.cr.commit()
+    return txs.filtered('provider_reference').mapped('provider_reference')
+
+
+def _open(method, url, data=None, headers=None):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(data).encode() if data is not None else None,
+        headers=dict(headers or {}, **{'Content-Type': 'application/json'}),
+        method=method,
+    )
+    with _opener.open(request, timeout=60) as response:
+        return response.read()
+
+
+def _call(method, url, data=None, headers=None):
+    return json.loads(_open(method, url, data, headers) or b'null')
+
+
+def _timed(method, url, data=None, headers=None):
+    """ Call the url and return its latency and whether it succeeded (redirects count as success). """
+    start = time.perf_counter()
+    try:
+        _open(method, url, data, headers)
+        ok = True
+    except urllib.error.HTTPError as e:
+        ok = 300 <= e.code < 400
+    except OSError:
+        ok = False
+    return time.perf_counter() - start, ok
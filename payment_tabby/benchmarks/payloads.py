@@ -0,0 +1,148 @@
+""" Microbenchmarks of the Tabby session and capture payload builders.
+
+Generates orders and buyer histories of increasing size in a scratch database
+and reports, for each payload builder, the wall time, the number of SQL
+queries and the peak Python memory of one call. The HTTP layer is stubbed out
+and every generated record is rolled back at the end of the run.
+
+Run it from an Odoo shell on a database where `payment_tabby` is installed::
+
+    $ odoo-bin shell -d tabby_bench --no-http <<< \\
+        "from odoo.addons.payment_tabby.benchmarks import payloads; payloads.run(env)"
+"""
+import time
+import tracemalloc
+
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from odoo.fields import Command
+
+from ..models.api import TabbyAPI
+from ..models.dd import DataDog
+
+LINE_COUNTS = (1, 10, 100, 500)
+HISTORY_COUNTS = (0, 10, 100, 1000, 10000)
+HISTORY_LINES = 3
+
+
+def run(env, line_counts=LINE_COUNTS, history_counts=HISTORY_COUNTS, rollback=True):
+    """ Run the benchmarks and print a report.
+
+    :param env: An environment on the benchmark database.
+    :param line_counts: The numbers of order lines to benchmark with.
+    :param history_counts: The numbers of past buyer orders to benchmark with.
+    :param bool rollback: Whether to roll back the generated data afterwards.
+    :return: The measures, as a list of (builder, size, seconds, queries, peak bytes).
+    :rtype: list
+    """
+    env = env(su=True, context=dict(env.context, lang='en_US'))
+    results = []
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(TabbyAPI, '_request', return_value={'status': 'error'}))
+        stack.enter_context(patch.object(DataDog, '_send_request'))
+        try:
+            bench = _Bench(env, max(line_counts, default=0))
+            for count in line_counts:
+                tx, order = bench.make_transaction(bench.make_partner(), count)
+                results.append(bench.measure('get_order_items', count, lambda: tx.get_order_items(order)))
+                results.append(bench.measure('get_payment_object', count, lambda: tx.get_payment_object(order)))
+                results.append(bench.measure('_get_tabby_capture_data', count, tx._get_tabby_capture_data))
+            for count in history_counts:
+                partner = bench.make_partner()
+                bench.make_history(partner, count)
+                tx, order = bench.make_transaction(partner, 1)
+                results.append(bench.measure(
+                    'get_customer_loyality_level', count, lambda: tx.get_customer_loyality_level(order)
+                ))
+                results.append(bench.measure(
+                    'get_order_history_object', count, lambda: tx.get_order_history_object(order)
+                ))
+        finally:
+            if rollback:
+                env.cr.rollback()
+
+    print(f"{'builder':<30} {'size':>6} {'wall ms':>10} {'queries':>8} {'peak KiB':>10}")
+    for name, size, seconds, queries, peak in results:
+        print(f"{name:<30} {size:>6} {seconds * 1000:>10.2f} {queries:>8} {peak / 1024:>10.1f}")
+    return results
+
+
+class _Bench:
+
+    def __init__(self, env, max_lines):
+        self.env = env
+        self.provider = env.ref('payment_tabby.payment_provider_tabby')
+        self.method = env.ref('payment_tabby.payment_method_tabby_installments')
+        self.currency = env.ref('base.AED')
+        self.currency.active = True
+        self.pricelist = env['product.pricelist'].create({
+            'name': "Tabby Benchmark", 'currency_id': self.currency.id,
+        })
+        self.products = env['product.product'].create([
+            {'name': f"Tabby Benchmark Product {i}", 'default_code': f"TBP{i}", 'list_price': 10 + i}
+            for i in range(max(max_lines, HISTORY_LINES))
+        ])
+        self.sequence = 0
+
+    def measure(self, name, size, builder):
+        """ Call the builder once on a cold cache and return its measures. """
+        self.env.invalidate_all()
+        cr = self.env.cr
+        queries = cr.sql_log_count
+        tracemalloc.start()
+        start = time.perf_counter()
+        builder()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return name, size, seconds, cr.sql_log_count - queries, peak
+
+    def make_partner(self):
+        self.sequence += 1
+        return self.env['res.partner'].create({
+            'name': f"Tabby Benchmark Buyer {self.sequence}",
+            'email': f"tabby.bench.{self.sequence}@example.com",
+            'phone': f"+97150000{self.sequence:04d}",
+            'street': "Sheikh Zayed Road",
+            'city': "Dubai",
+            'country_id': self.env.ref('base.ae').id,
+        })
+
+    def _order_values(self, partner, line_count, **values):
+        return dict(
+            partner_id=partner.id,
+            pricelist_id=self.pricelist.id,
+            order_line=[
+                Command.create({'product_id': product.id, 'product_uom_qty': 2})
+                for product in self.products[:line_count]
+            ],
+            **values,
+        )
+
+    def make_history(self, partner, count, batch_size=500):
+        """ Create `count` confirmed past orders for the partner. """
+        start = datetime.now() - timedelta(days=count + 1)
+        for offset in range(0, count, batch_size):
+            self.env['sale.order'].create([
+                self._order_values(partner, HISTORY_LINES, state='sale', date_order=start + timedelta(days=i))
+                for i in range(offset, min(offset + batch_size, count))
+            ])
+            self.env.flush_all()
+            self.env.invalidate_all()
+
+    def make_transaction(self, partner, line_count):
+        order = self.env['sale.order'].create(self._order_values(partner, line_count))
+        tx = self.env['payment.transaction'].create({
+            'provider_id': self.provider.id,
+            'payment_method_id': self.method.id,
+            'amount': order.amount_total,
+            'currency_id': self.currency.id,
+            'partner_id': partner.id,
+            'sale_order_ids': [Command.set(order.ids)],
+        })
+        # A transaction that is its own source takes the full, itemized capture path.
+        tx.source_transaction_id = tx
+        self.env.flush_all()
+        return tx, order
@@ -0,0 +1,119 @@
+""" Replay of recorded Tabby API traffic, as a regression benchmark.
+
+Record the traffic of a server by setting the `payment_tabby.record_path`
+system parameter (see `models/recorder.py`); each worker writes its own
+`<path>.<pid>` file. Then replay a recording against a copy of the database
+taken before it was made: the Tabby transactions of the recorded payments are
+refreshed in recording order, the API answering with the recorded responses,
+and the run is reported with its wall time, SQL queries, API calls served and
+the resulting transaction states. The fingerprint of the states changes
+whenever a code change makes the replay end differently.
+
+Run it from an Odoo shell::
+
+    $ odoo-bin shell -d tabby_copy --no-http <<< \\
+        "from odoo.addons.payment_tabby.benchmarks import replay; replay.run(env, '/tmp/tabby.jsonl.1234')"
+
+The `redirect` mode refreshes the transactions one by one as the success
+redirect and the webhook processor do; the `cron` mode refreshes them in
+batches as the pending transactions cron does. Everything is rolled back at
+the end of the run.
+
+To replay a recording through a running server instead, e.g. to re-run the
+controllers and the crons, set the `payment_tabby.replay_path` and
+`payment_tabby.replay_time_scale` system parameters.
+"""
+import hashlib
+import re
+import time
+
+from collections import Counter
+from contextlib import ExitStack
+from unittest.mock import patch
+
+from ..models.dd import DataDog
+from ..models.recorder import Replayer
+
+MODES = ('redirect', 'cron')
+
+
+def run(env, path, mode='redirect', time_scale=0.0, rollback=True):
+    """ Replay a recording and print a report.
+
+    :param env: An environment on a copy of the recorded database.
+    :param str path: The recording file.
+    :param str mode: How the transactions are refreshed: `redirect` or `cron`.
+    :param float time_scale: The factor applied to the recorded latencies and
+                             to the intervals between the recorded calls; 0
+                             replays as fast as possible.
+    :param bool rollback: Whether to roll back the changes afterwards.
+    :return: The measures of the run.
+    :rtype: dict
+    """
+    assert mode in MODES, f"Unknown mode {mode}, use one of {MODES}"
+    env = env(su=True)
+    replayer = Replayer(path, time_scale)
+    fetches = [
+        (entry['t'], match.group(1))
+        for entry in replayer.entries
+        if entry['method'] == 'GET' and (match := re.fullmatch(r'v2/payments/([^/]+)', entry['endpoint']))
+    ]
+    txs = env['payment.transaction'].search([
+        ('provider_code', '=', 'tabby'),
+        ('provider_reference', 'in', list({payment_id for _t, payment_id in fetches})),
+    ])
+    tx_by_reference = {tx.provider_reference: tx for tx in txs}
+
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(Replayer, 'get', return_value=replayer))
+        stack.enter_context(patch.object(DataDog, '_send_request'))
+        stack.enter_context(patch.object(env.cr, 'commit'))
+        served = Counter()
+        stack.enter_context(patch.object(
+            replayer, 'respond', side_effect=_count(replayer.respond, served),
+        ))
+        try:
+            queries = env.cr.sql_log_count
+            start = time.perf_counter()
+            if mode == 'redirect':
+                for t, payment_id in fetches:
+                    tx = tx_by_reference.get(payment_id)
+                    if not tx:
+                        continue
+                    delay = start + t * time_scale - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    if tx.state in ('draft', 'pending'):
+                        tx._tabby_update_payment_status()
+            else:
+                txs.filtered(lambda tx: tx.state in ('draft', 'pending'))._tabby_reconcile()
+            env.flush_all()
+            seconds = time.perf_counter() - start
+            queries = env.cr.sql_log_count - queries
+            states = sorted((tx.reference, tx.state) for tx in txs)
+        finally:
+            if rollback:
+                env.cr.rollback()
+
+    result = {
+        'mode': mode,
+        'transactions': len(txs),
+        'recorded_fetches': len(fetches),
+        'api_calls': sum(served.values()),
+        'seconds': seconds,
+        'queries': queries,
+        'states': dict(Counter(state for _reference, state in states)),
+        'fingerprint': hashlib.sha1(repr(states).encode()).hexdigest()[:12],
+    }
+    print(f"mode {result['mode']}, {result['transactions']} transactions, "
+          f"{result['recorded_fetches']} recorded fetches, {result['api_calls']} API calls replayed")
+    print(f"wall {seconds * 1000:.1f} ms, {queries} queries")
+    print(f"states {result['states']}, fingerprint {result['fingerprint']}")
+    return result
+
+
+def _count(respond, served):
+    def wrapper(method, endpoint, url):
+        served[method, endpoint] += 1
+        return respond(method, endpoint, url)
+    return wrapper
@@ -0,0 +1,242 @@
+""" Local stand-in for the Tabby API, for load tests.
+
+Implements the subset of the API used by the module: `v2/checkout`,
+`v2/payments/{id}` with captures, refunds and close, and `v1/webhooks`.
+Payments are kept in memory. Every API call can be delayed and can fail with
+a configurable probability. Authorizing a payment through the control route
+`POST /_standin/payments/{id}/authorize` notifies the registered webhooks.
+
+Point the module at it with the `payment_tabby.api_base_url` system parameter::
+
+    $ python payment_tabby/benchmarks/standin.py --port 8765 --latency 80 --jitter 40 --error-rate 0.01
+    # payment_tabby.api_base_url = http://localhost:8765/api/
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.request
+import uuid
+
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_logger = logging.getLogger(__name__)
+
+
+class StandinState:
+    """ The in-memory payments and webhooks of the stand-in, and its fault injection settings. """
+
+    def __init__(self, base_url, latency=0.0, jitter=0.0, error_rate=0.0, webhook_delay=0.0, webhook_header=None):
+        self.base_url = base_url.rstrip('/')
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.webhook_delay = webhook_delay
+        self.webhook_header = webhook_header
+        self.lock = threading.Lock()
+        self.payments = {}
+        self.webhooks = {}
+
+    def create_payment(self, data):
+        payment = dict(data.get('payment') or {})
+        payment.update({
+            'id': str(uuid.uuid4()),
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'status': 'CREATED',
+            'is_test': True,
+            'captures': [],
+            'refunds': [],
+        })
+        with self.lock:
+            self.payments[payment['id']] = payment
+        return {
+            'id': str(uuid.uuid4()),
+            'status': 'created',
+            'payment': payment,
+            'merchant_urls': data.get('merchant_urls', {}),
+            'configuration': {
+                'available_products': {
+                    'installments': [{'web_url': f"{self.base_url}/checkout?paymentId={payment['id']}"}],
+                },
+            },
+        }
+
+    def set_status(self, payment_id, status):
+        with self.lock:
+            payment = self.payments[payment_id]
+            payment['status'] = status
+        self.notify(payment)
+        return payment
+
+    def add_operation(self, payment_id, kind, data):
+        with self.lock:
+            payment = self.payments[payment_id]
+            payment[kind].append({
+                'id': str(uuid.uuid4()),
+                'amount': data.get('amount'),
+                'reference_id': data.get('reference_id'),
+                'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            })
+            if kind == 'captures':
+                captured = sum(float(c['amount'] or 0) for c in payment['captures'])
+                if captured >= float(payment.get('amount') or 0):
+                    payment['status'] = 'CLOSED'
+        return payment
+
+    def notify(self, payment):
+        """ Send the payment, as a webhook, to every registered webhook url, in the background. """
+        def send(url):
+            time.sleep(self.webhook_delay)
+            body = dict(payment, status=payment['status'].lower())
+            headers = {'Content-Type': 'application/json'}
+            if self.webhook_header:
+                headers[self.webhook_header['title']] = self.webhook_header['value']
+            try:
+                urllib.request.urlopen(urllib.request.Request(
+                    url, data=json.dumps(body).encode(), headers=headers, method='POST',
+                ), timeout=30).read()
+            except Exception as e:
+                _logger.warning("Webhook to %s failed: %s", url, e)
+
+        for hook in list(self.webhooks.values()):
+            threading.Thread(target=send, args=(hook['url'],), daemon=True).start()
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        ('POST', r'/api/v2/checkout', 'checkout'),
+        ('GET', r'/api/v2/payments/(?P<pid>[^/]+)', 'get_payment'),
+        ('POST', r'/api/v2/payments/(?P<pid>[^/]+)/captures', 'capture'),
+        ('POST', r'/api/v2/payments/(?P<pid>[^/]+)/refunds', 'refund'),
+        ('POST', r'/api/v2/payments/(?P<pid>[^/]+)/close', 'close'),
+        ('GET', r'/api/v1/webhooks', 'list_webhooks'),
+        ('POST', r'/api/v1/webhooks', 'register_webhook'),
+        ('PUT', r'/api/v1/webhooks/(?P<hid>[^/]+)', 'update_webhook'),
+        ('DELETE', r'/api/v1/webhooks/(?P<hid>[^/]+)', 'delete_webhook'),
+        ('POST', r'/_standin/payments/(?P<pid>[^/]+)/(?P<status>authorize|reject)', 'control'),
+    ]
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _dispatch(self, method):
+        path = self.path.split('?', 1)[0]
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length) or b'null') or {}
+        for route_method, pattern, handler in self.ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            return self._reply(404, {'status': 'error', 'errorType': 'not_found'})
+
+        if handler != 'control':
+            state = self.state
+            time.sleep(max(state.latency + random.uniform(-state.jitter, state.jitter), 0) / 1000)
+            if random.random() < state.error_rate:
+                return self._reply(500, {'status': 'error', 'errorType': 'injected_error'})
+        try:
+            status, body = getattr(self, f'_handle_{handler}')(data, **match.groupdict())
+        except KeyError:
+            status, body = 404, {'status': 'error', 'errorType': 'not_found'}
+        self._reply(status, body)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _handle_checkout(self, data):
+        return 200, self.state.create_payment(data)
+
+    def _handle_get_payment(self, data, pid):
+        return 200, self.state.payments[pid]
+
+    def _handle_capture(self, data, pid):
+        return 200, self.state.add_operation(pid, 'captures', data)
+
+    def _handle_refund(self, data, pid):
+        return 200, self.state.add_operation(pid, 'refunds', data)
+
+    def _handle_close(self, data, pid):
+        return 200, self.state.set_status(pid, 'CLOSED')
+
+    def _handle_control(self, data, pid, status):
+        return 200, self.state.set_status(pid, 'AUTHORIZED' if status == 'authorize' else 'REJECTED')
+
+    def _handle_list_webhooks(self, data):
+        return 200, list(self.state.webhooks.values())
+
+    def _handle_register_webhook(self, data):
+        hook = dict(data, id=str(uuid.uuid4()))
+        self.state.webhooks[hook['id']] = hook
+        if hook.get('header'):
+            self.state.webhook_header = hook['header']
+        return 200, hook
+
+    def _handle_update_webhook(self, data, hid):
+        self.state.webhooks[hid].update(data)
+        return 200, self.state.webhooks[hid]
+
+    def _handle_delete_webhook(self, data, hid):
+        return 200, self.state.webhooks.pop(hid)
+
+
+def serve(host='127.0.0.1', port=8765, **options):
+    """ Start the stand-in server in a background thread and return it. """
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.daemon_threads = True
+    server.state = StandinState(f"http://{host}:{server.server_port}", **options)
+    threading.Thread(target=server.serve_forever, name='tabby-standin', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="Added latency per API call, in ms.")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Maximum random latency deviation, in ms.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of API calls failing with a 500.")
+    parser.add_argument('--webhook-delay', type=float, default=0.0, help="Delay before sending webhooks, in s.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = serve(
+        args.host, args.port,
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, webhook_delay=args.webhook_delay,
+    )
+    _logger.info("Tabby stand-in listening on %s/api/", server.state.base_url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
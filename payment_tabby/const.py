@@ -24,3 +24,129 @@ DEFAULT_TERMS_URL = "https://www.tabby.ai/terms-and-conditions"
 DEFAULT_PRIVACY_URL = "https://www.tabby.ai/privacy-policy"
 
 TABBY_DEV_DOMAINS = False
+
+# Outbound HTTP client. Each worker keeps one keep-alive connection pool per
+# Tabby domain; these defaults can be overridden with the matching
+# `payment_tabby.*` system parameters.
+HTTP_POOL_SIZE = 10
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 10
+
+# Datadog log shipper: one background thread per worker sends queued entries
+# in batches. Above the high-water mark only one in DD_SAMPLE_RATE non-error
+# entries is kept; entries are dropped once the queue is full.
+DD_QUEUE_SIZE = 10000
+DD_QUEUE_HIGH_WATER = 8000
+DD_SAMPLE_RATE = 10
+DD_BATCH_MAX_ENTRIES = 500
+DD_BATCH_MAX_BYTES = 4 * 1024 * 1024
+DD_FLUSH_INTERVAL = 2
+
+# Pending transactions reconciliation cron
+CRON_BATCH_SIZE = 50
+CRON_FETCH_WORKERS = 8
+CRON_TIME_BUDGET = 240
+
+# Status polling of the pending Tabby transactions, in seconds. While a
+# transaction is younger than POLL_WINDOW, its next check is scheduled after
+# max(POLL_MIN_INTERVAL, its age), so checks back off exponentially. After
+# the window, a single last check runs POLL_LONG_TAIL after its creation.
+POLL_MIN_INTERVAL = 120
+POLL_WINDOW = 2 * 60 * 60
+POLL_LONG_TAIL = 24 * 60 * 60
+
+# Concurrent API calls of the back-office batch captures, refunds and voids
+BATCH_OPERATION_WORKERS = 8
+
+# Processed webhook events are kept this long in the inbox before being vacuumed.
+WEBHOOK_RETENTION_DAYS = 7
+
+# Events whose transaction was being refreshed by another process are processed
+# again after this many seconds.
+WEBHOOK_REQUEUE_DELAY = 30
+
+# Webhook authentication. The shared secret is registered with Tabby as a
+# custom header, which Tabby sends back on every webhook.
+WEBHOOK_AUTH_HEADER = 'X-Tabby-Webhook-Secret'
+
+# Provider fields whose change requires the webhooks to be synchronized with Tabby
+WEBHOOK_SYNC_FIELDS = (
+    'tabby_public_key', 'tabby_secret_key', 'tabby_webhook_auth_header', 'tabby_webhook_secret', 'state',
+    'available_currency_ids',
+)
+
+# Unknown provider references are rejected without a search for this many
+# seconds; at most this many of them are remembered per worker.
+UNKNOWN_REFERENCE_TTL = 60
+UNKNOWN_REFERENCE_CACHE_SIZE = 10000
+
+# The session payload of an unchanged order is reused for this many seconds,
+# which bounds the staleness of the buyer's loyalty and order history.
+SESSION_CACHE_TTL = 15 * 60
+
+# The outcome of a Tabby session creation (created or rejected) is reused for
+# this many seconds for the same buyer contact, currency and amount band.
+# Amount bands are geometric: each spans a factor of ELIGIBILITY_AMOUNT_BAND_RATIO.
+ELIGIBILITY_TTL = 10 * 60
+ELIGIBILITY_AMOUNT_BAND_RATIO = 1.25
+
+# An order is pre-scored at most once per PRESCORE_RETRY_DELAY seconds per
+# worker when no outcome is cached for it; at most PRESCORE_GUARD_SIZE orders
+# are remembered per worker.
+PRESCORE_RETRY_DELAY = 60
+PRESCORE_GUARD_SIZE = 10000
+
+# Upper bounds, in seconds, of the Tabby API latency histogram buckets
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Circuit breaker of the Tabby API calls, per merchant code and per worker. It
+# opens when over the last BREAKER_WINDOW calls (at least BREAKER_MIN_CALLS)
+# the rate of failed or slow calls reaches its threshold, and lets a probe
+# call through after BREAKER_COOLDOWN seconds.
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 10
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_SLOW_CALL_SECONDS = 5
+BREAKER_SLOW_CALL_RATE = 0.5
+BREAKER_COOLDOWN = 30
+
+# Total deadline, in seconds, of an attempt of each kind of Tabby API call,
+# from connection to the end of the response body; the connect and read
+# timeouts still apply within it. Overridable with the `payment_tabby.deadline.<kind>` system
+# parameters.
+API_DEADLINES = {
+    'checkout': 5,
+    'payment': 5,
+    'capture': 5,
+    'refund': 5,
+    'close': 10,
+    'webhooks': 10,
+}
+
+# Retries of the Tabby API calls sent with an idempotency key, by kind of call.
+# Overridable with the `payment_tabby.retries.<kind>` system parameters. The
+# delay before retry n is drawn from [0, min(MAX, BASE * 2 ** (n - 1))] seconds.
+API_RETRIES = {
+    'capture': 2,
+    'refund': 2,
+}
+API_RETRY_BASE_DELAY = 0.5
+API_RETRY_MAX_DELAY = 4
+# Wall-clock budget, in seconds, of a call and all its retries: a retry is only
+# made if it and its backoff can end within it, an attempt lasting at most its
+# deadline. Overridable with the `payment_tabby.retry_budget` system parameter.
+API_RETRY_BUDGET = 10
+
+# Datadog logging of the Tabby API calls (see models/log_policy.py). Failed
+# calls are always logged; successful ones are sampled.
+API_LOG_SAMPLE_RATE = 0.1
+API_LOG_MAX_LENGTH = 1024
+API_LOG_MAX_ITEMS = 5
+API_LOG_REDACT = {
+    'email': 'hash',
+    'phone': 'hash',
+    'name': 'drop',
+    'address': 'drop',
+    'zip': 'drop',
+    'order_history': 'drop',
+}
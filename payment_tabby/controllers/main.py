@@ -1,12 +1,21 @@
 from odoo import http
 from odoo.http import request
+import hmac
 import logging
 
 from ..models.dd import DataDog
+from ..models.metrics import Metrics
 
 _logger = logging.getLogger(__name__)
 
 class TabbyController(http.Controller):
+
+    def _tabby_get_transaction(self, reference, error_message, log_data):
+        """ Find the transaction of a Tabby payment id, logging unknown ids once per cache period. """
+        return request.env['payment.transaction'].sudo()._tabby_get_tx_from_provider_reference(
+            reference, log_message=error_message, log_data=log_data,
+        )
+
     @http.route('/payment/tabby/cancel', type='http', auth='public', methods=['GET'], csrf=False, website=True)
     def tabby_cancel(self, **kwargs):
         """ Handle Tabby payment cancel notifications. """
@@ -16,14 +25,14 @@ class TabbyController(http.Controller):
             DataDog.ddlog(self.env, 'error', 'Customer cancel redirect without payment_id detected', data=kwargs);
             return request.redirect('/shop')
 
-        tx_sudo = request.env['payment.transaction'].sudo().search([('provider_reference', '=', reference)], limit=1)
+        tx_sudo = self._tabby_get_transaction(reference, 'No transaction found on cancel redirect', kwargs)
         if not tx_sudo:
-            DataDog.ddlog(self.env, 'error', 'No transaction found on cancel redirect', data=kwargs);
             return request.redirect('/shop')
 
         # cancel only draft/pending transactions
         if tx_sudo.state in ('draft', 'pending') and tx_sudo.sale_order_ids:
             tx_sudo._set_canceled("Payment was canceled by the customer via Tabby.")
+            tx_sudo.tabby_next_check = False
 
             for order in tx_sudo.sale_order_ids:
                 request.session['sale_order_id'] = order.id
@@ -44,13 +53,13 @@ class TabbyController(http.Controller):
             DataDog.ddlog(self.env, 'error', 'Tabby failure redirect without payment_id', data=kwargs);
             return request.redirect('/shop')
 
-        tx_sudo = request.env['payment.transaction'].sudo().search([('provider_reference', '=', reference)], limit=1)
+        tx_sudo = self._tabby_get_transaction(reference, 'No transaction found on failure redirect', kwargs)
         if not tx_sudo:
-            DataDog.ddlog(self.env, 'error', 'No transaction found on failure redirect', data=kwargs);
             return request.redirect('/shop')
 
         if tx_sudo.state in ('draft', 'pending') and tx_sudo.sale_order_ids:
             tx_sudo._set_error("Payment is rejected by Tabby")
+            tx_sudo.tabby_next_check = False
 
             for order in tx_sudo.sale_order_ids:
                 request.session['sale_order_id'] = order.id
@@ -71,9 +80,8 @@ class TabbyController(http.Controller):
             DataDog.ddlog(self.env, 'error', 'Tabby success redirect without payment_id', data=kwargs);
             return request.redirect('/shop')
 
-        tx_sudo = request.env['payment.transaction'].sudo().search([('provider_reference', '=', reference)], limit=1)
+        tx_sudo = self._tabby_get_transaction(reference, 'No transaction found on success redirect', kwargs)
         if not tx_sudo:
-            DataDog.ddlog(self.env, 'error', 'No transaction found on success redirect', data=kwargs);
             return request.redirect('/shop')
 
         if tx_sudo.state in ['draft', 'pending']:
@@ -81,11 +89,27 @@ class TabbyController(http.Controller):
 
         return request.redirect('/shop/payment/validate')
 
+    @http.route('/payment/tabby/prepare', type='jsonrpc', auth='public', methods=['POST'], website=True)
+    def tabby_prepare(self, provider_id=None):
+        """ Build the Tabby session payload of the current cart and pre-score its buyer
+        while the customer is on the payment page. """
+        order_sudo = request.env['sale.order'].sudo().browse(request.session.get('sale_order_id')).exists()
+        provider_sudo = request.env['payment.provider'].sudo().browse(int(provider_id or 0)).exists()
+        eligible = None
+        if order_sudo and order_sudo.state == 'draft' and provider_sudo.code == 'tabby':
+            eligible = request.env['payment.transaction'].sudo()._tabby_prescore(provider_sudo, order_sudo)
+        return {"status": "success", "eligible": eligible}
+
     @http.route('/payment/tabby/webhook', type='jsonrpc', auth='public', methods=['POST'], csrf=False)
     def tabby_webhook(self, **kwargs):
         """ Handle Tabby webhook notifications. """
         webhook = request.get_json_data();
 
+        # Repeated unknown or foreign payment ids are rejected before any work.
+        if request.env['payment.transaction'].sudo()._tabby_is_unknown_reference(webhook.get('id')):
+            Metrics.inc('tabby_webhooks_total', {'outcome': 'unknown_cached'})
+            return {"status": "error", "message": "Transaction not found"}
+
         log_data = {
             'payment.id': webhook.get('id'),
             'order.reference_id': webhook.get('order', {}).get('reference_id'),
@@ -96,15 +120,35 @@ class TabbyController(http.Controller):
         reference = webhook.get('id')
 
         if not reference:
+            Metrics.inc('tabby_webhooks_total', {'outcome': 'missing_id'})
             return {"status": "error", "message": "Missing id"}
 
-        tx_sudo = request.env['payment.transaction'].sudo().search([('provider_reference', '=', reference)], limit=1)
-        if not tx_sudo:
-            DataDog.ddlog(self.env, 'error', 'No transaction found for webhook', data=log_data);
+        if not self._tabby_get_transaction(reference, 'No transaction found for webhook', log_data):
+            Metrics.inc('tabby_webhooks_total', {'outcome': 'unknown'})
             return {"status": "error", "message": "Transaction not found"}
 
-        if tx_sudo.state in ['draft', 'pending']:
-            tx_sudo._tabby_update_payment_status()
+        # The event is only stored here; the transaction is refreshed by the
+        # webhook processor cron so that Tabby is acknowledged right away.
+        verified = request.env['payment.provider'].sudo()._tabby_verify_webhook(request.httprequest.headers)
+        request.env['payment.tabby.webhook'].sudo()._enqueue(reference, webhook, verified=verified)
+        Metrics.inc('tabby_webhooks_total', {'outcome': 'queued_verified' if verified else 'queued'})
 
         return {"status": "success"}
 
+    @http.route('/payment/tabby/metrics', type='http', auth='public', methods=['GET'], csrf=False, save_session=False)
+    def tabby_metrics(self):
+        """ Expose the Tabby metrics of this worker, and the shared metrics of the crons,
+        in the Prometheus text format (see `Metrics`).
+
+        Scrapers authenticate with the `payment_tabby.metrics_token` system
+        parameter as a bearer token; the route is disabled while it is unset.
+        """
+        token = request.env['ir.config_parameter'].sudo().get_param('payment_tabby.metrics_token')
+        authorization = request.httprequest.headers.get('Authorization', '')
+        if not token or not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+            return request.make_response('Unauthorized', headers=[('Content-Type', 'text/plain')], status=401)
+
+        request.env['payment.transaction'].sudo()._tabby_update_backlog_metrics()
+        return request.make_response(
+            Metrics.render(request.env), headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')]
+        )
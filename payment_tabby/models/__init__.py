@@ -4,3 +4,11 @@ from . import payment_provider
 from . import payment_transaction
 from . import api
 from . import dd
+from . import payment_tabby_contact
+from . import payment_tabby_eligibility
+from . import payment_tabby_metric
+from . import payment_tabby_session_cache
+from . import payment_tabby_webhook
+from . import res_partner
+from . import sale_order
+from . import website
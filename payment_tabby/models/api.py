@@ -1,35 +1,163 @@
 import json
 import logging
+import os
 import pprint
+import random
+import re
+import socket
+import threading
+import time
+from urllib.parse import urlparse
 from .. import const
+from .breaker import CircuitBreaker
 from .dd import DataDog
+from .log_policy import LogPolicy
+from .metrics import Metrics
+from .recorder import Recorder, Replayer
 
 
-from uuid import uuid4
+from uuid import NAMESPACE_URL, uuid4, uuid5
+
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Timeout
 
 from odoo.addons.payment import utils as payment_utils
 
 _logger = logging.getLogger(__name__)
 
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _get_session(domain, pool_size):
+    """ Return the keep-alive HTTP session of this worker for a Tabby API host.
+
+    Sessions are keyed on the process id as well so that a pool created before
+    a fork is never shared between prefork workers.
+    """
+    key = (os.getpid(), domain)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[key] = session
+    return session
+
+
+def _is_retryable(response):
+    """ Return whether a call may be retried: it timed out, failed to connect, was throttled or failed server-side. """
+    return response is None or response.status_code >= 500 or response.status_code == 429
+
+
+def _read_body(response, deadline):
+    """ Read the body of a streamed response, aborting it once the deadline has passed.
+
+    urllib3's total timeout bounds the connection and each wait for data, not
+    the whole body: a response trickling in would outlast it. A watchdog shuts
+    the connection down at the deadline, which wakes up the blocked read.
+
+    :param float deadline: The `time.monotonic` value by which the body must be read, if any.
+    :raise requests.exceptions.ReadTimeout: If the deadline passed before the body was read.
+    """
+    if deadline is None:
+        response.content
+        return
+    lock = threading.Lock()
+    done = threading.Event()
+    aborted = threading.Event()
+
+    def abort():
+        with lock:
+            if done.is_set():
+                return
+            aborted.set()
+        sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    watchdog = threading.Timer(max(deadline - time.monotonic(), 0), abort)
+    watchdog.start()
+    try:
+        response.content
+    except requests.exceptions.RequestException:
+        if not aborted.is_set():
+            raise
+    finally:
+        with lock:
+            done.set()
+        watchdog.cancel()
+    if aborted.is_set():
+        response.close()
+        raise requests.exceptions.ReadTimeout(f"Deadline exceeded while reading the response of {response.url}")
+
+
+def _decode_json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
 class TabbyAPI:
 
     def __init__(self, provider, country_code = None, transaction = None):
         self.public_key = provider.tabby_public_key
         self.secret_key = provider.tabby_secret_key
+        self.webhook_auth_header = provider.tabby_webhook_auth_header or const.WEBHOOK_AUTH_HEADER
+        self.webhook_secret = provider.tabby_webhook_secret
         self.env = provider.env
         self.country_code = country_code or 'AE'
 
         if transaction:
             self.country_code = provider.get_merchant_code_from_currency(transaction.currency_id.name)
 
+        ICP = self.env['ir.config_parameter'].sudo()
+        self.pool_size = int(ICP.get_param('payment_tabby.http_pool_size', const.HTTP_POOL_SIZE))
+        self.timeout = (
+            float(ICP.get_param('payment_tabby.http_connect_timeout', const.HTTP_CONNECT_TIMEOUT)),
+            float(ICP.get_param('payment_tabby.http_read_timeout', const.HTTP_READ_TIMEOUT)),
+        )
+        # Points every merchant code at another API host, e.g. the local stand-in server
+        # of the load tests (see benchmarks/standin.py).
+        self.api_base_url = ICP.get_param('payment_tabby.api_base_url')
+        self.deadlines = {
+            kind: float(ICP.get_param(f'payment_tabby.deadline.{kind}', deadline))
+            for kind, deadline in const.API_DEADLINES.items()
+        }
+        self.retries = {
+            kind: int(ICP.get_param(f'payment_tabby.retries.{kind}', retries))
+            for kind, retries in const.API_RETRIES.items()
+        }
+        self.retry_budget = float(ICP.get_param('payment_tabby.retry_budget', const.API_RETRY_BUDGET))
+        self.log_policy = LogPolicy(self.env)
+        # Resolved here so that calls made from worker threads never use the cursor.
+        self.log_metadata = DataDog.get_metadata(self.env)
+        # Record or replay of the API traffic (see models/recorder.py).
+        self.recorder = Recorder.get(ICP.get_param('payment_tabby.record_path'))
+        self.replayer = Replayer.get(
+            ICP.get_param('payment_tabby.replay_path'),
+            float(ICP.get_param('payment_tabby.replay_time_scale', 1)),
+        )
+
     def get_tabby_domain(self, mcode):
         d1 = 'dev' if const.TABBY_DEV_DOMAINS else ('sa' if mcode == 'SA' else 'ai')
         d2 = 'tabbysa' if (const.TABBY_DEV_DOMAINS and mcode == 'SA') else 'tabby'
         return f"{d2}.{d1}"
 
     def _get_base_api_url(self, mcode):
+        if self.api_base_url:
+            return f"{self.api_base_url.rstrip('/')}/"
         return f"https://api.{self.get_tabby_domain(mcode)}/api/"
 
     def _get_endpoint_url(self, mcode, endpoint):
@@ -44,119 +172,280 @@ class TabbyAPI:
             headers["X-Merchant-Code"] = mcode
         return headers
 
-    def _request(self, method, endpoint, data=None, mcode=None):
+    def _request(self, method, endpoint, data=None, mcode=None, kind=None, idempotency_key=None):
+        """ Call the Tabby API.
+
+        Calls sent with an idempotency key are retried with exponential backoff
+        and jitter when they time out or get a 5xx or 429 response, up to the
+        number of retries of their kind (see `const.API_RETRIES`), and only as
+        long as another attempt and its backoff fit in the retry budget of the
+        call (see `const.API_RETRY_BUDGET`).
+
+        :param str kind: The kind of call, which sets its deadline (see `const.API_DEADLINES`).
+        :param str idempotency_key: The key making the call safe to send more than once.
+        :return: The decoded response, or an error dict.
+        """
 
         if not self.secret_key:
             return {'status':'error', 'message': f"No secret key configured"}
 
         url = self._get_endpoint_url(mcode or self.country_code, endpoint)
         headers = self._get_headers(mcode)
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
 
         if (method not in ['POST', 'GET', 'PUT', 'DELETE']):
             raise ValueError("Unsupported HTTP method")
 
-        try:
-            response = requests.request(method, url, headers=headers, data=json.dumps(data) if data else None, timeout=10)
-            response.raise_for_status()
-
-            rjson = None
-            try:
-                rjson = response.json()
-            except json.JSONDecodeError:
-                pass
-            log_data = {
-                "request.url" : url,
-                "request.body" : data,
-                "request.method" : method,
-                "response.body" : rjson or response.text,
-                "response.status" : response.status_code,
-                "response.error" : ''
-            }
-            DataDog.ddlog(self.env, 'info', 'api call', data=log_data);
-        except requests.exceptions.RequestException as e:
-            _logger.error('Tabby API Request Failed: %s', e)
-            rjson = None
-            try:
-                rjson = response.json()
-            except json.JSONDecodeError:
-                pass
+        labels = {
+            'endpoint': re.sub(r'(payments|webhooks)/[^/]+', r'\1/{id}', endpoint),
+            'merchant_code': mcode or self.country_code,
+        }
+        breaker = CircuitBreaker.get(mcode or self.country_code)
+        if not breaker.allow():
+            Metrics.inc('tabby_api_responses_total', dict(labels, method=method, code='circuit_open'))
+            return {"status": "error", "message": "Tabby API is unavailable (circuit open)"}
+
+        session = _get_session(urlparse(url).netloc, self.pool_size)
+        body = json.dumps(data) if data else None
+        connect_timeout, read_timeout = self.timeout
+        # The deadline bounds the whole attempt: urllib3 enforces it up to the
+        # response headers, and `_read_body` while the body is read.
+        deadline = self.deadlines.get(kind)
+        timeout = Timeout(connect=connect_timeout, read=read_timeout, total=deadline)
+        attempt_duration = deadline or connect_timeout + read_timeout
+        max_attempts = 1 + (self.retries.get(kind, 0) if idempotency_key else 0)
+        call_deadline = time.monotonic() + self.retry_budget
+        attempt = 0
+        while True:
+            attempt += 1
+            response, error = self._send(
+                session, method, endpoint, url, headers, body, timeout, deadline, breaker, labels,
+            )
+            if attempt >= max_attempts or not _is_retryable(response):
+                break
+            delay = self._get_retry_delay(attempt, response)
+            if time.monotonic() + delay + attempt_duration > call_deadline:
+                # Another attempt could overrun the call's budget.
+                break
+            Metrics.inc('tabby_api_retries_total', dict(labels, method=method))
+            time.sleep(delay)
+            # A breaker opened meanwhile by other calls stops the retries.
+            if not breaker.allow():
+                break
+
+        # The body is decoded once and reused for both the log entry and the result.
+        rjson = _decode_json(response) if response is not None else None
+        # The log policy is applied before anything is serialized: unsampled
+        # calls cost nothing and logged bodies are redacted and truncated.
+        if self.log_policy.should_log(kind, failed=bool(error)):
             log_data = {
                 "request.url" : url,
-                "request.body" : data,
+                "request.body" : self.log_policy.sanitize(data),
                 "request.method" : method,
-                "response.body" : rjson or response.text,
-                "response.status" : response.status_code,
-                "response.error" : ''
+                "request.attempts" : attempt,
+                "response.body" : self.log_policy.sanitize(
+                    rjson if rjson is not None else (response.text if response is not None else '')
+                ),
+                "response.status" : response.status_code if response is not None else None,
+                "response.error" : str(error) if error else ''
             }
-            DataDog.ddlog(self.env, 'info', 'api call', data=log_data);
-            return {"status": "error", "message": str(e)}
-
-        try:
-            return response.json()
-        except json.JSONDecodeError:
+            DataDog.ddlog(
+                self.env, 'error' if error else 'info', 'api call', data=log_data, metadata=self.log_metadata,
+            )
+
+        if error:
+            result = {"status": "error", "message": str(error)}
+            if response is not None:
+                # Keep what Tabby said about the error, e.g. to tell an unknown merchant code apart.
+                result['status_code'] = response.status_code
+                if isinstance(rjson, dict) and rjson.get('errorType'):
+                    result['errorType'] = rjson['errorType']
+            return result
+
+        if rjson is None:
             _logger.warning("Tabby API response error: %s", response.text)
             return {"status": "error", "message": "Failed to decode JSON response"}
+        return rjson
+
+    def _send(self, session, method, endpoint, url, headers, body, timeout, deadline, breaker, labels):
+        """ Send one attempt of a call and record its outcome on the breaker and the metrics.
+
+        In replay mode, the recorded response is served instead; in recording
+        mode, the attempt is written to the recording.
+
+        :param float deadline: The number of seconds the attempt may last, if bounded.
+        :return: The response, or None when none was received, and the error, if any.
+        :rtype: tuple
+        """
+        response = None
+        error = None
+        start = time.monotonic()
+        try:
+            if self.replayer:
+                response = self.replayer.respond(method, endpoint, url)
+            else:
+                response = session.request(method, url, headers=headers, data=body, timeout=timeout, stream=True)
+                _read_body(response, start + deadline if deadline else None)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            _logger.error('Tabby API Request Failed: %s', e)
+            error = e
+
+        elapsed = time.monotonic() - start
+        if self.recorder:
+            self.recorder.record(method, endpoint, labels['merchant_code'], body, response, error, elapsed, self.log_policy)
+        breaker.record(failed=_is_retryable(response), elapsed=elapsed)
+        Metrics.observe('tabby_api_request_duration_seconds', elapsed, labels)
+        Metrics.inc('tabby_api_responses_total', dict(
+            labels, method=method, code=str(response.status_code) if response is not None else 'error',
+        ))
+        return response, error
+
+    def _get_retry_delay(self, attempt, response):
+        """ Return the delay before the next attempt: exponential backoff with full jitter,
+        but no shorter than the Retry-After of a throttled response. """
+        ceiling = min(const.API_RETRY_MAX_DELAY, const.API_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+        delay = random.uniform(0, ceiling)
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), const.API_RETRY_MAX_DELAY))
+        return delay
+
+    def get_idempotency_key(self, payment_id, operation, reference):
+        """ Return the idempotency key of an operation, derived from the reference of its transaction. """
+        return str(uuid5(NAMESPACE_URL, f'tabby:{payment_id}:{operation}:{reference}'))
 
     def createSession(self, data):
-        return self._request("POST", f'v2/checkout', data=data)
+        return self._request("POST", f'v2/checkout', data=data, kind='checkout')
 
     def get_payment(self, payment_id):
-        return self._request("GET", f'v2/payments/{payment_id}')
+        return self._request("GET", f'v2/payments/{payment_id}', kind='payment')
 
     def capture(self, payment_id, data):
-        return self._request("POST", f'v2/payments/{payment_id}/captures', data=data);
+        response = self._request(
+            "POST", f'v2/payments/{payment_id}/captures', data=data, kind='capture',
+            idempotency_key=self.get_idempotency_key(payment_id, 'capture', data.get('reference_id')),
+        )
+        return self._confirm_operation(payment_id, response, 'captures', data.get('reference_id'))
 
     def refund(self, payment_id, data):
-        return self._request("POST", f'v2/payments/{payment_id}/refunds', data=data);
+        response = self._request(
+            "POST", f'v2/payments/{payment_id}/refunds', data=data, kind='refund',
+            idempotency_key=self.get_idempotency_key(payment_id, 'refund', data.get('reference_id')),
+        )
+        return self._confirm_operation(payment_id, response, 'refunds', data.get('reference_id'))
+
+    def _confirm_operation(self, payment_id, response, collection, reference):
+        """ Look a failed capture or refund up on the payment.
+
+        A call that timed out, or was retried after its first attempt went
+        through, may still have moved the money: the payment then lists the
+        operation under its reference and is returned instead of the error.
+        """
+        if not reference or not self.isError(response):
+            return response
+        payment = self.get_payment(payment_id)
+        if isinstance(payment, dict) and any(
+            item.get('reference_id') == reference for item in payment.get(collection) or []
+        ):
+            _logger.info('Tabby %s %s found on payment %s after a failed call.', collection, reference, payment_id)
+            return payment
+        return response
 
     def close(self, payment_id):
-        return self._request("POST", f'v2/payments/{payment_id}/close');
+        return self._request("POST", f'v2/payments/{payment_id}/close', kind='close')
 
     def register_webhooks(self, webhook_url, mcodes):
-        for mcode in mcodes:
-            hooks = self.get_webhooks(mcode)
-            if self.isNotAuthorized(hooks):
-                _logger.error('Merchant code %s not found when registering webhook.', mcode)
-                continue
-
-            _logger.info("Webhook object: %s", hooks);
-            hook = next((h for h in hooks if h['url'] == webhook_url), None)
-            registered = False
-            if hook:
-                registered = True
-                if self.getIsTest() != hook.get('is_test', False):
-                    self.update_webhook(hook.get('id'), webhook_url, mcode)
-                    _logger.info('Updated webhook for mcode %s to is_test=%s', mcode, self.getIsTest())
-
-                _logger.info('Webhook already registered for mcode %s: %s', mcode, webhook_url)
-                continue
-            if not registered:
-                response = self.register_webhook(webhook_url, mcode)
-                _logger.info('Registered webhook for mcode %s: %s', mcode, response)
+        """ Register the webhook for the merchant codes, in parallel.
+
+        :return: Whether the webhook is registered for every merchant code.
+        :rtype: bool
+        """
+        return all(self._for_each_mcode(lambda mcode: self._register_mcode_webhook(webhook_url, mcode), mcodes))
+
+    def _register_mcode_webhook(self, webhook_url, mcode):
+        hooks = self.get_webhooks(mcode)
+        if self.isNotAuthorized(hooks) or self.isError(hooks):
+            _logger.error('Merchant code %s not found when registering webhook.', mcode)
+            return False
+
+        _logger.info("Webhook object: %s", hooks)
+        hook = next((h for h in hooks if h.get('url') == webhook_url), None)
+        if hook:
+            if self.getIsTest() != hook.get('is_test', False) or self.get_webhook_header() != hook.get('header'):
+                response = self.update_webhook(hook.get('id'), webhook_url, mcode)
+                _logger.info('Updated webhook for mcode %s to is_test=%s', mcode, self.getIsTest())
+                return not self.isError(response)
+
+            _logger.info('Webhook already registered for mcode %s: %s', mcode, webhook_url)
+            return True
+
+        response = self.register_webhook(webhook_url, mcode)
+        _logger.info('Registered webhook for mcode %s: %s', mcode, response)
+        return not self.isError(response)
 
     def unregister_webhooks(self, webhook_url, mcodes):
-        for mcode in mcodes:
-            hooks = self.get_webhooks(mcode)
-            if isinstance(hooks, dict) and hooks.get('status', '') == 'error':
-                _logger.error('Merchant code %s not found when unregistering webhook.', mcode)
-                continue;
-            if self.isNotAuthorized(hooks):
-                _logger.error('Merchant code %s not found when unregistering webhook.', mcode)
-                continue
-
-            hook = next((h for h in hooks if h['url'] == webhook_url), None)
-            if hook:
-                _logger.info('Unregistering webhook for mcode %s: %s, %s', mcode, webhook_url, hook)
-                self.delete_webhook(hook.get('id'), mcode)
+        """ Unregister the webhook for the merchant codes, in parallel.
+
+        :return: Whether no merchant code failed.
+        :rtype: bool
+        """
+        return all(self._for_each_mcode(lambda mcode: self._unregister_mcode_webhook(webhook_url, mcode), mcodes))
+
+    def _unregister_mcode_webhook(self, webhook_url, mcode):
+        hooks = self.get_webhooks(mcode)
+        if self.isNotAuthorized(hooks):
+            # Merchant codes unknown to these keys have no webhook to remove.
+            _logger.info('Merchant code %s not found when unregistering webhook.', mcode)
+            return True
+        if self.isError(hooks):
+            # Timeouts, server errors or an open breaker: the webhook may still
+            # be registered, so the sync must be retried.
+            _logger.error('Failed to list the webhooks of merchant code %s when unregistering webhook.', mcode)
+            return False
+
+        hook = next((h for h in hooks if h.get('url') == webhook_url), None)
+        if hook:
+            _logger.info('Unregistering webhook for mcode %s: %s, %s', mcode, webhook_url, hook)
+            return not self.isError(self.delete_webhook(hook.get('id'), mcode))
+        return True
+
+    def _for_each_mcode(self, func, mcodes):
+        """ Call `func` for each merchant code, concurrently, and return the results.
+
+        The calls must not use the cursor: the API calls log with the metadata
+        resolved when the client was built.
+        """
+        if len(mcodes) <= 1:
+            return [func(mcode) for mcode in mcodes]
+        with ThreadPoolExecutor(max_workers=len(mcodes)) as executor:
+            return list(executor.map(func, mcodes))
+
+    def isError(self, response):
+        if isinstance(response, list):
+            return any(self.isError(item) for item in response)
+        return isinstance(response, dict) and (response.get('status') == 'error' or bool(response.get('errorType')))
 
     def isNotAuthorized(self, response):
-        return hasattr(response, 'errorType') and response.errorType in ['not_authorized', 'not_found']
+        """ Return whether Tabby refused the call because the keys don't know the merchant code or resource. """
+        if isinstance(response, list):
+            return any(self.isNotAuthorized(item) for item in response)
+        return isinstance(response, dict) and (
+            response.get('errorType') in ['not_authorized', 'not_found']
+            or response.get('status_code') in (401, 403, 404)
+        )
 
     def getIsTest(self):
         return self.secret_key.startswith('sk_test_')
 
+    def get_webhook_header(self):
+        if not self.webhook_secret:
+            return None
+        return {"title": self.webhook_auth_header, "value": self.webhook_secret}
+
     def get_webhooks(self, mcode):
-        webhooks = self._request("GET", f"v1/webhooks", mcode=mcode)
+        webhooks = self._request("GET", f"v1/webhooks", mcode=mcode, kind='webhooks')
         if not isinstance(webhooks, list):
             webhooks = [webhooks]
         return webhooks
@@ -166,13 +455,17 @@ class TabbyAPI:
             "url": webhook_url,
             "is_test": self.secret_key.startswith('sk_test_'),
         }
-        return self._request("POST", f"v1/webhooks", data=data, mcode=mcode)
+        if self.webhook_secret:
+            data["header"] = self.get_webhook_header()
+        return self._request("POST", f"v1/webhooks", data=data, mcode=mcode, kind='webhooks')
 
     def update_webhook(self, hook_id, webhook_url, mcode):
         data = {
             "url": webhook_url,
         }
-        return self._request("PUT", f"v1/webhooks/{hook_id}", data=data, mcode=mcode)
+        if self.webhook_secret:
+            data["header"] = self.get_webhook_header()
+        return self._request("PUT", f"v1/webhooks/{hook_id}", data=data, mcode=mcode, kind='webhooks')
 
     def delete_webhook(self, hook_id, mcode):
-        return self._request("DELETE", f"v1/webhooks/{hook_id}", mcode=mcode)
+        return self._request("DELETE", f"v1/webhooks/{hook_id}", mcode=mcode, kind='webhooks')
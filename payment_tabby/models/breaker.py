@@ -0,0 +1,93 @@
+import threading
+import time
+
+from collections import deque
+
+from .. import const
+from .metrics import Metrics
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """ Circuit breaker of the Tabby API calls of one merchant code, in this worker.
+
+    The breaker opens when, over the last calls, too many failed or were too
+    slow. While open, calls fail fast. After a cooldown a single probe call is
+    let through (half-open): its success closes the breaker, its failure opens
+    it again.
+    """
+
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, mcode):
+        self.mcode = mcode
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self.calls = deque(maxlen=const.BREAKER_WINDOW)  # (failed, slow)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, mcode):
+        breaker = cls._breakers.get(mcode)
+        if breaker is None:
+            with cls._breakers_lock:
+                breaker = cls._breakers.setdefault(mcode, cls(mcode))
+        return breaker
+
+    @classmethod
+    def is_open(cls, mcode):
+        """ Return whether calls for the merchant code are currently failing fast. """
+        breaker = cls._breakers.get(mcode)
+        return bool(breaker) and breaker.state == OPEN and time.monotonic() < breaker.opened_at + const.BREAKER_COOLDOWN
+
+    def allow(self):
+        """ Return whether a call may be made now. """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() < self.opened_at + const.BREAKER_COOLDOWN:
+                    return False
+                self._set_state(HALF_OPEN)
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, failed, elapsed):
+        """ Record the outcome of a call made after `allow()`.
+
+        :param bool failed: Whether the call failed on Tabby's side (no response, 5xx or 429).
+        :param float elapsed: The duration of the call, in seconds.
+        """
+        slow = elapsed >= const.BREAKER_SLOW_CALL_SECONDS
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+                if failed or slow:
+                    self._open()
+                else:
+                    self.calls.clear()
+                    self._set_state(CLOSED)
+                return
+
+            self.calls.append((failed, slow))
+            if len(self.calls) < const.BREAKER_MIN_CALLS:
+                return
+            failures = sum(1 for f, _s in self.calls if f) / len(self.calls)
+            slow_calls = sum(1 for _f, s in self.calls if s) / len(self.calls)
+            if failures >= const.BREAKER_FAILURE_RATE or slow_calls >= const.BREAKER_SLOW_CALL_RATE:
+                self._open()
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self.calls.clear()
+        self._set_state(OPEN)
+
+    def _set_state(self, state):
+        self.state = state
+        Metrics.set('tabby_circuit_state', _STATE_VALUES[state], {'merchant_code': self.mcode})
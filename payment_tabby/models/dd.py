@@ -1,41 +1,159 @@
-import requests
+import atexit
 import json
-import threading
 import logging
+import os
+import queue
+import threading
+import time
+
+import requests
 from odoo import release
 from odoo.http import request
 
+from .. import const
+
 _logger = logging.getLogger(__name__)
 
+
+class _LogShipper:
+    """ Long-lived background shipper for Datadog log entries.
+
+    Entries are put in a bounded in-memory queue and sent by a single daemon
+    thread in multi-record POSTs, flushed when a batch is full (by count or by
+    size) or when its oldest entry is older than the flush interval. The
+    thread reuses one keep-alive connection. When the queue fills up beyond
+    its high-water mark, non-error entries are sampled; when it is full they
+    are dropped. Both are counted.
+    """
+
+    URL = "https://logs.browser-intake-datadoghq.eu/api/v2/logs"
+    HEADERS = {
+        "Content-Type": "application/json",
+        "DD-API-KEY": "pub52c39090d2b6827fe4bad20d337da6ae",
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._session = None
+        self._seen = 0
+        self.counters = {'queued': 0, 'sent': 0, 'failed': 0, 'sampled_out': 0, 'dropped': 0}
+
+    def _ensure_started(self):
+        # The thread and the queue belong to the process that started them:
+        # restart them in a forked worker.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=const.DD_QUEUE_SIZE)
+            self._session = requests.Session()
+            self._thread = threading.Thread(target=self._run, name='tabby-datadog-shipper', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def submit(self, entry):
+        self._ensure_started()
+        if entry.get('status') != 'error' and self._queue.qsize() >= const.DD_QUEUE_HIGH_WATER:
+            self._seen += 1
+            if self._seen % const.DD_SAMPLE_RATE:
+                self.counters['sampled_out'] += 1
+                return
+        try:
+            self._queue.put_nowait(entry)
+            self.counters['queued'] += 1
+        except queue.Full:
+            self.counters['dropped'] += 1
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+
+    def _run(self):
+        batch, size, deadline = [], 0, None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = None
+
+            if entry is not None and entry is not self:
+                encoded = json.dumps(entry, default=str)
+                if batch and size + len(encoded) > const.DD_BATCH_MAX_BYTES:
+                    self._send(batch)
+                    batch, size = [], 0
+                batch.append(encoded)
+                size += len(encoded) + 1
+                if deadline is None:
+                    deadline = time.monotonic() + const.DD_FLUSH_INTERVAL
+
+            flush_now = (
+                entry is self  # flush marker
+                or len(batch) >= const.DD_BATCH_MAX_ENTRIES
+                or (deadline is not None and time.monotonic() >= deadline)
+            )
+            if flush_now and batch:
+                self._send(batch)
+                batch, size = [], 0
+            if flush_now:
+                deadline = None
+            if entry is not None:
+                self._queue.task_done()
+
+    def _send(self, batch):
+        try:
+            response = self._session.post(
+                self.URL, headers=self.HEADERS, data=f"[{','.join(batch)}]", timeout=10
+            )
+            response.raise_for_status()
+            self.counters['sent'] += len(batch)
+        except Exception as e:
+            self.counters['failed'] += len(batch)
+            _logger.debug("DataDog batch of %s entries failed: %s", len(batch), e)
+
+    def flush(self, timeout=5):
+        """ Push out everything queued so far, waiting at most `timeout` seconds. """
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(self, timeout=timeout)
+        except queue.Full:
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+
+_shipper = _LogShipper()
+atexit.register(_shipper.flush)
+
+
 class DataDog:
 
     @staticmethod
     def _send_request(payload):
-        url = "https://logs.browser-intake-datadoghq.eu/api/v2/logs"
-        headers = {
-            "Content-Type": "application/json",
-            "DD-API-KEY": "pub52c39090d2b6827fe4bad20d337da6ae",
-        }
-        try:
-            response = requests.post(url, headers=headers, data=json.dumps(payload), timeout=10)
-        except Exception as e:
-            #_logger.warning("DataDog Background Log Failed: %s", e)
-            pass
+        _shipper.submit(payload)
 
     @classmethod
-    def ddlog(cls, env, status, message, exception=None, data=None):
+    def ddlog(cls, env, status, message, exception=None, data=None, metadata=None):
+        """ Queue a log entry for Datadog.
 
-        hostname = cls.get_hostname(env)
-        module_version = cls.get_module_version(env)
+        :param dict metadata: The metadata of the entry, as returned by
+                              `get_metadata`; resolved from `env` if not given.
+        """
+        metadata = metadata or cls.get_metadata(env)
 
         log_entry = {
             "status": status,
             "message": message,
             "service": "odoo",
             "sversion": release.version,
-            "hostname": hostname,
+            "hostname": metadata['hostname'],
             "ddsource": "python",
-            "ddtags": f"env:prod,version:{module_version}",
+            "ddtags": f"env:prod,version:{metadata['version']}",
         }
 
         if exception:
@@ -45,17 +163,33 @@ class DataDog:
         if data:
             log_entry["data"] = data
 
-        thread = threading.Thread(target=cls._send_request, args=(log_entry,), daemon=True)
-        thread.start()
+        cls._send_request(log_entry)
+
+    @classmethod
+    def get_metadata(cls, env):
+        """ Return the hostname and module version of the log entries.
+
+        Code running in worker threads logs with metadata resolved in the
+        calling thread, as `env` and its cursor may not be used there.
+        """
+        return {'hostname': cls.get_hostname(env), 'version': cls.get_module_version(env)}
+
+    @staticmethod
+    def get_stats():
+        """ Return the shipper counters and the current queue depth of this worker. """
+        return dict(_shipper.counters, queue_depth=_shipper.qsize())
+
+    @staticmethod
+    def flush(timeout=5):
+        _shipper.flush(timeout=timeout)
 
     @staticmethod
     def get_hostname(env):
         if request and hasattr(request, 'httprequest'):
             return request.httprequest.host
 
-        return env['website'].get_current_website().domain or 'localhost'
+        return env['payment.provider']._tabby_get_hostname() or 'localhost'
 
     @staticmethod
     def get_module_version(env):
-        module = env['ir.module.module'].sudo().search([('name', '=', 'payment_tabby')], limit=1)
-        return module.installed_version or 'unknown'
+        return env['payment.provider']._tabby_get_installed_version() or 'unknown'
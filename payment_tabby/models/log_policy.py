@@ -0,0 +1,68 @@
+import hashlib
+import random
+
+from .. import const
+
+
+class LogPolicy:
+    """ Which Tabby API calls are logged to Datadog, and how much of their bodies.
+
+    Failed calls are always logged; successful calls are sampled at a rate per
+    kind of call. Logged bodies are redacted (configured fields dropped or
+    hashed) and truncated (long strings and lists shortened) field by field,
+    before anything is serialized.
+
+    The policy is read from the system parameters:
+
+    - `payment_tabby.log_sample_rate` and `payment_tabby.log_sample_rate.<kind>`:
+      the fraction of successful calls logged, between 0 and 1;
+    - `payment_tabby.log_max_length`: the maximum length of a logged string;
+    - `payment_tabby.log_max_items`: the maximum number of logged list items;
+    - `payment_tabby.log_redact`: comma-separated `field:drop` or `field:hash` rules.
+    """
+
+    def __init__(self, env):
+        ICP = env['ir.config_parameter'].sudo()
+        default_rate = float(ICP.get_param('payment_tabby.log_sample_rate', const.API_LOG_SAMPLE_RATE))
+        self.sample_rates = {
+            kind: float(ICP.get_param(f'payment_tabby.log_sample_rate.{kind}', default_rate))
+            for kind in const.API_DEADLINES
+        }
+        self.default_rate = default_rate
+        self.max_length = int(ICP.get_param('payment_tabby.log_max_length', const.API_LOG_MAX_LENGTH))
+        self.max_items = int(ICP.get_param('payment_tabby.log_max_items', const.API_LOG_MAX_ITEMS))
+        rules = ICP.get_param('payment_tabby.log_redact')
+        if rules:
+            self.redact = dict(rule.strip().split(':', 1) for rule in rules.split(',') if ':' in rule)
+        else:
+            self.redact = dict(const.API_LOG_REDACT)
+
+    def should_log(self, kind, failed):
+        if failed:
+            return True
+        rate = self.sample_rates.get(kind, self.default_rate)
+        return rate >= 1 or random.random() < rate
+
+    def sanitize(self, value, truncate=True):
+        """ Return a redacted and, unless `truncate` is False, truncated copy of a request or response body. """
+        if isinstance(value, dict):
+            result = {}
+            for key, item in value.items():
+                action = self.redact.get(key)
+                if action == 'drop':
+                    continue
+                if action == 'hash':
+                    result[key] = hashlib.sha256(str(item).encode()).hexdigest()[:16] if item else item
+                else:
+                    result[key] = self.sanitize(item, truncate)
+            return result
+        if isinstance(value, list) and not truncate:
+            return [self.sanitize(item, truncate) for item in value]
+        if isinstance(value, list):
+            result = [self.sanitize(item) for item in value[:self.max_items]]
+            if len(value) > self.max_items:
+                result.append(f"... {len(value) - self.max_items} more")
+            return result
+        if truncate and isinstance(value, str) and len(value) > self.max_length:
+            return f"{value[:self.max_length]}... ({len(value)} chars)"
+        return value
@@ -0,0 +1,164 @@
+import os
+import threading
+
+from collections import defaultdict
+
+from odoo.tools import SQL
+
+from .. import const
+
+# name: (type, help)
+DEFINITIONS = {
+    'tabby_api_request_duration_seconds': ('histogram', "Latency of the Tabby API calls."),
+    'tabby_api_responses_total': ('counter', "Tabby API calls by HTTP status code, or 'error' when no response was received."),
+    'tabby_api_retries_total': ('counter', "Tabby API calls retried after a timeout, a 5xx or a 429 response."),
+    'tabby_webhooks_total': ('counter', "Tabby webhooks received, by outcome."),
+    'tabby_webhook_events_processed_total': ('counter', "Webhook events processed, by how the payment was obtained."),
+    'tabby_status_refreshes_total': ('counter', "Tabby status refreshes, by whether the transaction was claimed or skipped because another process held it."),
+    'tabby_pending_transactions': ('gauge', "Draft or pending Tabby transactions."),
+    'tabby_pending_webhook_events': ('gauge', "Webhook events waiting to be processed."),
+    'tabby_cron_transactions': ('gauge', "Transactions selected by the last run of the pending transactions cron."),
+    'tabby_cron_remaining_transactions': ('gauge', "Transactions left over by the last run of the pending transactions cron."),
+    'tabby_cron_duration_seconds': ('gauge', "Duration of the last run of the pending transactions cron."),
+    'tabby_circuit_state': ('gauge', "Circuit breaker of the Tabby API calls: 0 closed, 1 half-open, 2 open."),
+    'tabby_datadog_queue_depth': ('gauge', "Log entries waiting in the Datadog shipper queue."),
+    'tabby_datadog_entries_total': ('counter', "Datadog log entries, by outcome."),
+}
+
+# Gauges counted in the database at scrape time, which every worker reports
+# alike: they are rendered without a `pid` label so as not to be summed.
+DATABASE_GAUGES = {'tabby_pending_transactions', 'tabby_pending_webhook_events'}
+
+
+class _Registry:
+    """ The metrics of this worker, kept in memory. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = defaultdict(float)  # (name, labels): value, for counters and gauges
+        self._histograms = {}  # (name, labels): [bucket counts, sum, count]
+
+    def inc(self, name, labels, value):
+        with self._lock:
+            self._values[name, labels] += value
+
+    def set(self, name, labels, value):
+        with self._lock:
+            self._values[name, labels] = value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self._histograms.setdefault((name, labels), [[0] * len(const.METRICS_BUCKETS), 0.0, 0])
+            for i, bound in enumerate(const.METRICS_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def samples(self):
+        """ Yield (name, labels, value) for every sample, histograms expanded in buckets. """
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+        for (name, labels), value in values.items():
+            yield name, name, labels, value
+        for (name, labels), (buckets, total, count) in histograms.items():
+            for bound, bucket_count in zip(const.METRICS_BUCKETS, buckets):
+                yield name, f'{name}_bucket', labels + (('le', str(bound)),), bucket_count
+            yield name, f'{name}_bucket', labels + (('le', '+Inf'),), count
+            yield name, f'{name}_sum', labels, total
+            yield name, f'{name}_count', labels, count
+
+
+_registry = _Registry()
+
+
+def _labels(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _render_labels(labels):
+    return ','.join(f'{key}="{_escape(val)}"' for key, val in labels)
+
+
+class Metrics:
+    """ The Tabby metrics, in the Prometheus text exposition format.
+
+    Most metrics are kept in the memory of the worker that records them and are
+    rendered with a `pid` label: in prefork mode a scrape only reaches one HTTP
+    worker, so each worker's series must be aggregated across pids and will
+    have gaps unless every worker is scraped. The `DATABASE_GAUGES`, counted
+    anew by each scrape, carry no `pid` label.
+
+    The metrics recorded by the crons, which no scrape can reach, are shared
+    instead: `set_shared` and `inc_shared` store them in the database, from
+    where every worker renders them without a `pid` label. They are written on
+    a separate, immediately committed cursor so that no lock on them is held
+    by the caller's transaction.
+    """
+
+    @staticmethod
+    def inc(name, labels=None, value=1):
+        _registry.inc(name, _labels(labels), value)
+
+    @staticmethod
+    def set(name, value, labels=None):
+        _registry.set(name, _labels(labels), value)
+
+    @staticmethod
+    def observe(name, value, labels=None):
+        _registry.observe(name, _labels(labels), value)
+
+    @staticmethod
+    def set_shared(env, name, value, labels=None):
+        Metrics._write_shared(env, name, labels, value, increment=False)
+
+    @staticmethod
+    def inc_shared(env, name, labels=None, value=1):
+        if value:
+            Metrics._write_shared(env, name, labels, value, increment=True)
+
+    @staticmethod
+    def _write_shared(env, name, labels, value, increment):
+        label_text = _render_labels(_labels(labels))
+        with env.registry.cursor() as cr:
+            cr.execute(SQL(
+                """
+                INSERT INTO payment_tabby_metric (name, labels, value, create_date, write_date)
+                VALUES (%(name)s, %(labels)s, %(value)s, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC')
+                ON CONFLICT (name, labels)
+                DO UPDATE SET value = CASE WHEN %(increment)s THEN payment_tabby_metric.value + EXCLUDED.value
+                                           ELSE EXCLUDED.value END,
+                              write_date = EXCLUDED.write_date
+                """,
+                name=name, labels=label_text, value=value, increment=increment,
+            ))
+
+    @staticmethod
+    def render(env=None):
+        """ Return the metrics of this worker, and the shared ones if an env is given. """
+        families = defaultdict(list)
+        pid = (('pid', str(os.getpid())),)
+        for family, name, labels, value in _registry.samples():
+            if family in DATABASE_GAUGES:
+                label_text = _render_labels(labels)
+                families[family].append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+            else:
+                label_text = _render_labels(labels + pid)
+                families[family].append(f"{name}{{{label_text}}} {value}")
+        if env is not None:
+            for name, label_text, value in env.execute_query(SQL(
+                "SELECT name, labels, value FROM payment_tabby_metric ORDER BY name, labels"
+            )):
+                families[name].append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        lines = []
+        for family, samples in sorted(families.items()):
+            metric_type, help_text = DEFINITIONS.get(family, ('untyped', ''))
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {metric_type}")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
@@ -1,9 +1,11 @@
+import hashlib
+import hmac
 import json
 import re
 
 from datetime import datetime
 
-from odoo import _, api, fields, models
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import ValidationError
 from odoo.fields import Command
 from odoo.http import request
@@ -11,6 +13,8 @@ from odoo.http import request
 from odoo.addons.payment.logging import get_payment_logger
 from .. import const
 
+from odoo.addons.payment import utils as payment_utils
+from ..models.breaker import CircuitBreaker
 from ..models.dd import DataDog
 from ..models.api import TabbyAPI
 
@@ -43,6 +47,27 @@ class PaymentProvider(models.Model):
         groups="base.group_system"
     )
 
+    tabby_webhook_auth_header = fields.Char(
+        string="Webhook Authentication Header",
+        help="Name of the header carrying the shared secret on Tabby webhooks",
+        default=const.WEBHOOK_AUTH_HEADER,
+        groups="base.group_system"
+    )
+
+    tabby_webhook_fingerprint = fields.Char(
+        string="Webhook Synchronization Fingerprint",
+        help="Fingerprint of the webhook URL, keys and merchant codes last synchronized with Tabby",
+        copy=False, readonly=True,
+        groups="base.group_system"
+    )
+
+    tabby_webhook_secret = fields.Char(
+        string="Webhook Secret",
+        help="Shared secret registered with Tabby and sent back on every webhook. When set, "
+             "authenticated webhooks are applied directly without fetching the payment again.",
+        groups="base.group_system"
+    )
+
     def get_tabby_promo_config(self):
         """ Get Tabby promo widget configuration. """
         self.ensure_one()
@@ -67,6 +92,62 @@ class PaymentProvider(models.Model):
 
         return result
 
+    @api.model
+    def _tabby_get_storefront_widget(self):
+        """ Return the Tabby promo widget of the current website for the storefront templates.
+
+        :return: The widget `config` and the `promo_script_url`, or an empty dict
+                 if no active Tabby provider supports the website's currency.
+        :rtype: dict
+        """
+        website = request.website
+        data = self._tabby_get_storefront_data(website.id, website.currency_id.name)
+        if not data or CircuitBreaker.is_open(data['config']['merchantCode']):
+            return {}
+        partner = self.env.user.partner_id
+        return {
+            'config': dict(
+                data['config'],
+                lang=(self.env.lang or 'en')[:2],
+                email=partner.email or '',
+                phone=partner.phone or '',
+            ),
+            'promo_script_url': data['promo_script_url'],
+        }
+
+    @api.model
+    @tools.ormcache('website_id', 'currency')
+    def _tabby_get_storefront_data(self, website_id, currency):
+        """ Resolve the active Tabby provider of a website and its static widget data.
+
+        Cached per worker; the cache is cleared when a Tabby provider is created,
+        written or deleted, or the company or domain of a website changes.
+        """
+        website = self.env['website'].browse(website_id)
+        provider = self.sudo().search([
+            ('code', '=', 'tabby'),
+            ('state', 'in', ['enabled', 'test']),
+            ('company_id', '=', website.company_id.id),
+            ('website_id', 'in', [False, website_id]),
+        ], limit=1)
+        country_code = next((k for k, v in const.COUNTRY_MAP.items() if v == currency), None)
+        if not provider or not country_code:
+            return None
+
+        api = TabbyAPI(provider=provider, country_code=country_code)
+        return {
+            'provider_id': provider.id,
+            'config': {
+                'selector': '#tabbyPromo',
+                'merchantCode': country_code,
+                'publicKey': provider.tabby_public_key,
+                'shouldInheritBg': True,
+                'source': 'product',
+                'sourcePlugin': 'odoo',
+            },
+            'promo_script_url': f"https://checkout.{api.get_tabby_domain(country_code)}/tabby-promo.js",
+        }
+
     def get_tabby_card_config(self, order):
         """ Get Tabby card widget configuration. """
         self.ensure_one()
@@ -79,6 +160,15 @@ class PaymentProvider(models.Model):
             # Order currency is not supported by Tabby (e.g. USD); hide the widget.
             return {}
 
+        if CircuitBreaker.is_open(merchant_code):
+            # Tabby is failing; don't offer it until the breaker closes again.
+            return {}
+
+        eligibility = self.env['payment.tabby.eligibility'].sudo()
+        if eligibility._lookup(order.partner_id, order.currency_id, order.amount_total) is False:
+            # Tabby just rejected this buyer for a similar amount.
+            return {}
+
         return {
             'selector': '#installmentsCard',
             'merchantCode': merchant_code,
@@ -89,6 +179,32 @@ class PaymentProvider(models.Model):
             'shouldInheritBg': True,
         }
 
+    @api.model
+    def _get_compatible_providers(self, *args, currency_id=None, report=None, **kwargs):
+        """ Override of `payment` to hide Tabby while its circuit breaker is open, and
+        from buyers it has just rejected. """
+        providers = super()._get_compatible_providers(*args, currency_id=currency_id, report=report, **kwargs)
+
+        currency = self.env['res.currency'].browse(currency_id).exists()
+        merchant_code = const.CURRENCY_MAP.get(currency.name)
+        if merchant_code and CircuitBreaker.is_open(merchant_code):
+            unavailable_providers = providers.filtered(lambda p: p.code == 'tabby')
+            providers -= unavailable_providers
+            payment_utils.add_to_report(
+                report, unavailable_providers, available=False, reason=_("Tabby is temporarily unavailable"),
+            )
+
+        order = self.env['sale.order'].browse(kwargs.get('sale_order_id')).exists()
+        if order and providers.filtered(lambda p: p.code == 'tabby'):
+            eligibility = self.env['payment.tabby.eligibility'].sudo()
+            if eligibility._lookup(order.partner_id, order.currency_id, order.amount_total) is False:
+                rejected_providers = providers.filtered(lambda p: p.code == 'tabby')
+                providers -= rejected_providers
+                payment_utils.add_to_report(
+                    report, rejected_providers, available=False, reason=_("Tabby did not approve this purchase"),
+                )
+        return providers
+
     def _get_supported_currencies(self):
         """Override to limit the dropdown to a specific list of currencies."""
         # Call super to get the standard list if needed, or define your own
@@ -130,64 +246,165 @@ class PaymentProvider(models.Model):
             )
         return country_code
 
+    # The metadata below is read on every checkout and with every API log line.
+    # It is cached per worker in the registry ormcache, which Odoo clears (and
+    # signals to the other workers) whenever a system parameter is written,
+    # and which is rebuilt with the registry when the module is upgraded.
+
     def _get_merchant_urls(self):
         """ Prepare merchant URLs for Tabby API. """
-        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        return dict(self._tabby_get_cached_merchant_urls())
+
+    @tools.ormcache()
+    def _tabby_get_cached_merchant_urls(self):
+        base_url = self._tabby_get_base_url()
         return {
             'success': f"{base_url}/payment/tabby/success",
             'cancel': f"{base_url}/payment/tabby/cancel",
             'failure': f"{base_url}/payment/tabby/failure",
         }
 
-    def get_plugin_version(self):
-        """ Get the current version of the Tabby plugin. """
+    @tools.ormcache()
+    def _tabby_get_base_url(self):
+        return self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+
+    @tools.ormcache()
+    def _tabby_get_installed_version(self):
         module = self.env['ir.module.module'].sudo().search(
             [('name', '=', 'payment_tabby')], limit=1)
-        return module.installed_version or '1.0'
+        return module.installed_version
+
+    @tools.ormcache('self.env.context.get("website_id")')
+    def _tabby_get_hostname(self):
+        return self.env['website'].sudo().get_current_website().domain
+
+    def get_plugin_version(self):
+        """ Get the current version of the Tabby plugin. """
+        return self._tabby_get_installed_version() or '1.0'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        providers = super().create(vals_list)
+        if any(p.code == 'tabby' for p in providers):
+            self.env.registry.clear_cache()  # _tabby_get_webhook_secrets, _tabby_get_storefront_data
+        return providers
+
+    def unlink(self):
+        tabby = any(p.code == 'tabby' for p in self)
+        res = super().unlink()
+        if tabby:
+            self.env.registry.clear_cache()  # _tabby_get_webhook_secrets, _tabby_get_storefront_data
+        return res
 
     def write(self, vals):
         res = super(PaymentProvider, self).write(vals)
 
-        for provider in self:
-            if provider.code == 'tabby':
-                if 'tabby_public_key' in vals or 'tabby_secret_key' in vals or 'state' in vals:
-                    if self.state in ['enabled', 'test']:
-                        provider._register_webhooks()
-                    else:
-                        self._unregister_webhooks()
-                    DataDog.ddlog(self.env, 'info', f'Tabby configuration updated for {provider.name}')
+        tabby_providers = self.filtered(lambda p: p.code == 'tabby')
+        if tabby_providers and set(vals) != {'tabby_webhook_fingerprint'}:
+            self.env.registry.clear_cache()  # _tabby_get_webhook_secrets, _tabby_get_storefront_data
+
+        if tabby_providers and any(f in vals for f in const.WEBHOOK_SYNC_FIELDS):
+            # Webhooks are synchronized in the background once the form is saved.
+            self.env.ref('payment_tabby.ir_cron_tabby_sync_webhooks')._trigger()
+            for provider in tabby_providers:
+                DataDog.ddlog(self.env, 'info', f'Tabby configuration updated for {provider.name}')
 
         return res
 
-    def _register_webhooks(self):
-        url = f"{self.env['ir.config_parameter'].sudo().get_param('web.base.url')}/payment/tabby/webhook"
+    def _tabby_get_webhook_fingerprint(self):
+        """ Return a fingerprint of what the webhooks of the provider should be at Tabby. """
+        self.ensure_one()
+        registered = self.state in ['enabled', 'test']
+        return hashlib.sha256(json.dumps([
+            registered,
+            self._tabby_get_webhook_url(),
+            self.tabby_secret_key,
+            self._tabby_get_webhook_mcodes() if registered else [],
+            self.tabby_webhook_auth_header,
+            self.tabby_webhook_secret,
+        ]).encode()).hexdigest()
+
+    @api.model
+    def _cron_tabby_sync_webhooks(self):
+        """ Register or unregister the webhooks of the Tabby providers whose configuration changed. """
+        for provider in self.search([('code', '=', 'tabby')]):
+            fingerprint = provider._tabby_get_webhook_fingerprint()
+            if fingerprint == provider.tabby_webhook_fingerprint:
+                continue
+            if provider.state in ['enabled', 'test']:
+                synced = provider._register_webhooks()
+            elif provider.tabby_secret_key:
+                synced = provider._unregister_webhooks()
+            else:
+                synced = True
+            if synced:
+                provider.tabby_webhook_fingerprint = fingerprint
+            self.env.cr.commit()
+
+    @api.model
+    @tools.ormcache()
+    def _tabby_get_webhook_secrets(self):
+        providers = self.sudo().search([
+            ('code', '=', 'tabby'),
+            ('state', 'in', ['enabled', 'test']),
+            ('tabby_webhook_secret', '!=', False),
+        ])
+        return tuple((p.tabby_webhook_auth_header or const.WEBHOOK_AUTH_HEADER, p.tabby_webhook_secret) for p in providers)
+
+    @api.model
+    def _tabby_verify_webhook(self, headers):
+        """ Check whether a webhook carries the shared secret of an active Tabby provider.
+
+        :param headers: The headers of the webhook request.
+        :return: Whether the webhook is authenticated.
+        :rtype: bool
+        """
+        return any(
+            hmac.compare_digest(headers.get(header, '').encode(), secret.encode())
+            for header, secret in self._tabby_get_webhook_secrets()
+        )
+
+    def _tabby_get_webhook_url(self):
+        return f"{self._tabby_get_base_url()}/payment/tabby/webhook"
+
+    def _tabby_get_webhook_mcodes(self):
         enabled = self.available_currency_ids.mapped('name')
-        mcodes = [k for k, v in const.COUNTRY_MAP.items() if v in enabled]
+        return [k for k, v in const.COUNTRY_MAP.items() if v in enabled]
+
+    def _register_webhooks(self):
+        url = self._tabby_get_webhook_url()
+        mcodes = self._tabby_get_webhook_mcodes()
 
         _logger.info('Registering webhooks for Tabby provider: %s, mcodes: %s with URL: %s', self.name, mcodes, url)
         api = TabbyAPI(provider=self)
-        api.register_webhooks(webhook_url=url, mcodes=mcodes)
-        self.env['bus.bus']._sendone(self.env.user.partner_id, 'simple_notification', {
-            'type': 'info',
-            'title': 'Tabby Webhooks Updated',
-            'message': 'Webhooks have been successfully registered/updated with Tabby.',
+        synced = api.register_webhooks(webhook_url=url, mcodes=mcodes)
+        self.env['bus.bus']._sendone(self.write_uid.partner_id, 'simple_notification', {
+            'type': 'info' if synced else 'warning',
+            'title': 'Tabby Webhooks Updated' if synced else 'Tabby Webhooks Not Updated',
+            'message': 'Webhooks have been successfully registered/updated with Tabby.' if synced else
+                       'Webhooks could not be registered with Tabby for every merchant code; '
+                       'this will be retried.',
             'sticky': False,
         })
+        return synced
 
     def _unregister_webhooks(self):
-        url = f"{self.env['ir.config_parameter'].sudo().get_param('web.base.url')}/payment/tabby/webhook"
+        url = self._tabby_get_webhook_url()
         mcodes = [k for k, v in const.COUNTRY_MAP.items()]
 
         _logger.info('Unregistering webhooks for Tabby provider: %s, mcodes: %s with URL: %s', self.name, mcodes, url)
         api = TabbyAPI(provider=self)
-        api.unregister_webhooks(webhook_url=url, mcodes=mcodes)
-
-        self.env['bus.bus']._sendone(self.env.user.partner_id, 'simple_notification', {
-            'type': 'info',
-            'title': 'Tabby Webhooks Unregistered',
-            'message': 'Webhooks have been successfully unregistered with Tabby.',
+        synced = api.unregister_webhooks(webhook_url=url, mcodes=mcodes)
+
+        self.env['bus.bus']._sendone(self.write_uid.partner_id, 'simple_notification', {
+            'type': 'info' if synced else 'warning',
+            'title': 'Tabby Webhooks Unregistered' if synced else 'Tabby Webhooks Not Unregistered',
+            'message': 'Webhooks have been successfully unregistered with Tabby.' if synced else
+                       'Webhooks could not be unregistered with Tabby for every merchant code; '
+                       'this will be retried.',
             'sticky': False,
         })
+        return synced
 
     @api.constrains('tabby_public_key', 'tabby_secret_key', 'state')
     def _check_keys_on_save(self):
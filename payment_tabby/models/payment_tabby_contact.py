@@ -0,0 +1,82 @@
+import re
+
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+
+class PaymentTabbyContact(models.Model):
+    _name = 'payment.tabby.contact'
+    _description = "Tabby Buyer Contact Key"
+    _order = 'id'
+
+    key = fields.Char(
+        string="Key", required=True, readonly=True,
+        help="The normalized email (e:) or phone number (p:) of the partner.",
+    )
+    partner_id = fields.Many2one(
+        string="Partner", comodel_name='res.partner', required=True, readonly=True, index=True, ondelete='cascade',
+    )
+
+    # Also serves the lookups by key of the buyer history.
+    _key_partner_uniq = models.UniqueIndex("(key, partner_id)")
+
+    def init(self):
+        # Index the partners that existed before the module was installed. The
+        # SQL normalization must match `_get_keys`.
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO payment_tabby_contact (key, partner_id)
+            SELECT DISTINCT key, id FROM (
+                SELECT 'e:' || lower(btrim(email, E' \\t\\r\\n')) AS key, id FROM res_partner
+                 UNION ALL
+                SELECT 'p:' || regexp_replace(phone, '\\D', '', 'g'), id FROM res_partner
+            ) AS keys
+            WHERE key NOT IN ('e:', 'p:')
+              AND NOT EXISTS (SELECT 1 FROM payment_tabby_contact LIMIT 1)
+            ON CONFLICT DO NOTHING
+            """
+        ))
+
+    @api.model
+    def _normalize_email(self, email):
+        return (email or '').strip().lower()
+
+    @api.model
+    def _normalize_phone(self, phone):
+        return re.sub(r'\D', '', phone or '')
+
+    @api.model
+    def _get_keys(self, partners):
+        """ Return the contact keys of the partners: their normalized emails and phone numbers. """
+        keys = set()
+        for partner in partners:
+            if email := self._normalize_email(partner.email):
+                keys.add(f'e:{email}')
+            if phone := self._normalize_phone(partner.phone):
+                keys.add(f'p:{phone}')
+        return keys
+
+    @api.model
+    def _get_partners(self, partners):
+        """ Return the partners sharing an email or a phone number with the given partners.
+
+        Emails are matched regardless of case and phone numbers regardless of
+        formatting.
+
+        :param recordset partners: The partners, as a `res.partner` recordset.
+        :rtype: recordset of `res.partner`
+        """
+        keys = self._get_keys(partners)
+        if not keys:
+            return self.env['res.partner']
+        return self.search_fetch([('key', 'in', list(keys))], ['partner_id']).partner_id
+
+    @api.model
+    def _sync(self, partners):
+        """ Rebuild the contact keys of the partners. """
+        self.search([('partner_id', 'in', partners.ids)]).unlink()
+        self.create([
+            {'key': key, 'partner_id': partner.id}
+            for partner in partners
+            for key in self._get_keys(partner)
+        ])
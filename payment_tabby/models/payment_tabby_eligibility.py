@@ -0,0 +1,106 @@
+import hashlib
+import math
+
+from datetime import timedelta
+
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+from .. import const
+
+
+class PaymentTabbyEligibility(models.Model):
+    _name = 'payment.tabby.eligibility'
+    _description = "Tabby Buyer Eligibility"
+    _order = 'id'
+
+    key = fields.Char(
+        string="Key", required=True, readonly=True,
+        help="Hash of the buyer's contact, the currency and the amount band.",
+    )
+    eligible = fields.Boolean(string="Eligible", readonly=True)
+    reason = fields.Char(string="Rejection Reason", readonly=True)
+
+    _key_uniq = models.UniqueIndex("(key)")
+
+    @api.model
+    def _get_key(self, partner, currency, amount):
+        """ Return the cache key of a buyer, currency and amount, or None if the buyer has no contact.
+
+        Amounts are grouped in geometric bands, so that small changes to the
+        cart keep the outcome while a much larger order is scored again.
+
+        :param recordset partner: The buyer, as a `res.partner` record.
+        :param recordset currency: The currency, as a `res.currency` record.
+        :param float amount: The amount of the order.
+        :rtype: str|None
+        """
+        contacts = self.env['payment.tabby.contact']
+        email = contacts._normalize_email(partner.email)
+        phone = contacts._normalize_phone(partner.phone or partner.mobile)
+        if not (email or phone):
+            return None
+        band = int(math.log(amount, const.ELIGIBILITY_AMOUNT_BAND_RATIO)) if amount > 1 else 0
+        return hashlib.sha1(f'{email}|{phone}|{currency.name}|{band}'.encode()).hexdigest()
+
+    @api.model
+    def _lookup(self, partner, currency, amount):
+        """ Return the fresh outcome of the last session created for the buyer, currency and amount.
+
+        :return: Whether the buyer was eligible, or None if no outcome is known.
+        :rtype: bool|None
+        """
+        key = self._get_key(partner, currency, amount)
+        if not key:
+            return None
+        rows = self.env.execute_query(SQL(
+            "SELECT eligible FROM payment_tabby_eligibility WHERE key = %s AND write_date >= %s",
+            key,
+            fields.Datetime.now() - timedelta(seconds=const.ELIGIBILITY_TTL),
+        ))
+        return rows[0][0] if rows else None
+
+    @api.model
+    def _record(self, partner, currency, amount, session):
+        """ Remember the outcome of a Tabby session creation.
+
+        Only sessions created or rejected by Tabby are recorded: a failed call
+        says nothing about the buyer.
+
+        :param dict session: The response of `createSession`.
+        :return: Whether the buyer is eligible, or None if the outcome is unknown.
+        :rtype: bool|None
+        """
+        status = session.get('status') if isinstance(session, dict) else None
+        if status not in ('created', 'rejected'):
+            return None
+        eligible = status == 'created'
+        key = self._get_key(partner, currency, amount)
+        if key:
+            installments = (
+                (session.get('configuration') or {}).get('products') or {}
+            ).get('installments') or {}
+            self.env.cr.execute(SQL(
+                """
+                INSERT INTO payment_tabby_eligibility
+                    (key, eligible, reason, create_uid, write_uid, create_date, write_date)
+                VALUES (%(key)s, %(eligible)s, %(reason)s, %(uid)s, %(uid)s,
+                        NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC')
+                ON CONFLICT (key)
+                DO UPDATE SET eligible = EXCLUDED.eligible,
+                              reason = EXCLUDED.reason,
+                              write_uid = EXCLUDED.write_uid,
+                              write_date = EXCLUDED.write_date
+                """,
+                key=key,
+                eligible=eligible,
+                reason=None if eligible else installments.get('rejection_reason'),
+                uid=self.env.uid,
+            ))
+        return eligible
+
+    @api.autovacuum
+    def _gc_expired_outcomes(self):
+        self.search([
+            ('write_date', '<', fields.Datetime.now() - timedelta(seconds=const.ELIGIBILITY_TTL)),
+        ]).unlink()
@@ -0,0 +1,14 @@
+from odoo import fields, models
+
+
+class PaymentTabbyMetric(models.Model):
+    _name = 'payment.tabby.metric'
+    _description = "Tabby Shared Metric"
+    _order = 'id'
+
+    # Written and read in SQL by `Metrics` (see models/metrics.py).
+    name = fields.Char(string="Name", required=True, readonly=True)
+    labels = fields.Char(string="Labels", required=True, default='', readonly=True)
+    value = fields.Float(string="Value", readonly=True)
+
+    _name_labels_uniq = models.UniqueIndex("(name, labels)")
@@ -0,0 +1,70 @@
+import json
+
+from datetime import timedelta
+
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+from .. import const
+
+
+class PaymentTabbySessionCache(models.Model):
+    _name = 'payment.tabby.session.cache'
+    _description = "Tabby Session Payload Cache"
+    _order = 'id'
+
+    order_id = fields.Many2one(
+        string="Order", comodel_name='sale.order', required=True, readonly=True, ondelete='cascade',
+    )
+    key = fields.Char(string="Key", required=True, readonly=True)
+    payload = fields.Json(string="Payload", readonly=True)
+
+    _order_id_uniq = models.UniqueIndex("(order_id)")
+
+    @api.model
+    def _get(self, order, key):
+        """ Return the cached session payload of the order if it was built for this key and is still fresh. """
+        rows = self.env.execute_query(SQL(
+            """
+            SELECT payload FROM payment_tabby_session_cache
+             WHERE order_id = %s AND key = %s AND write_date >= %s
+            """,
+            order.id,
+            key,
+            fields.Datetime.now() - timedelta(seconds=const.SESSION_CACHE_TTL),
+        ))
+        return rows[0][0] if rows else None
+
+    @api.model
+    def _set(self, order, key, payload):
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO payment_tabby_session_cache
+                (order_id, key, payload, create_uid, write_uid, create_date, write_date)
+            VALUES (%(order_id)s, %(key)s, %(payload)s, %(uid)s, %(uid)s,
+                    NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC')
+            ON CONFLICT (order_id)
+            DO UPDATE SET key = EXCLUDED.key,
+                          payload = EXCLUDED.payload,
+                          write_uid = EXCLUDED.write_uid,
+                          write_date = EXCLUDED.write_date
+            """,
+            order_id=order.id,
+            key=key,
+            payload=json.dumps(payload),
+            uid=self.env.uid,
+        ))
+
+    @api.model
+    def _clear(self, orders):
+        if not orders:
+            return
+        self.env.cr.execute(SQL(
+            "DELETE FROM payment_tabby_session_cache WHERE order_id IN %s", tuple(orders.ids),
+        ))
+
+    @api.autovacuum
+    def _gc_expired_payloads(self):
+        self.search([
+            ('write_date', '<', fields.Datetime.now() - timedelta(seconds=const.SESSION_CACHE_TTL)),
+        ]).unlink()
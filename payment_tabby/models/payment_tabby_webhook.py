@@ -0,0 +1,185 @@
+import json
+import logging
+import time
+
+from datetime import timedelta
+
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+from .. import const
+from .dd import DataDog
+from .metrics import Metrics
+
+_logger = logging.getLogger(__name__)
+
+
+class PaymentTabbyWebhook(models.Model):
+    _name = 'payment.tabby.webhook'
+    _description = "Tabby Webhook Event"
+    _order = 'id'
+
+    payment_id = fields.Char(string="Tabby Payment ID", required=True, readonly=True)
+    payload = fields.Json(string="Latest Payload", readonly=True)
+    state = fields.Selection(
+        selection=[('pending', "Pending"), ('done', "Processed")],
+        required=True, default='pending', readonly=True, index=True,
+    )
+    verified = fields.Boolean(
+        string="Authenticated", readonly=True,
+        help="Whether the latest payload carried the provider's webhook secret.",
+    )
+    hits = fields.Integer(
+        string="Received", default=1, readonly=True,
+        help="The number of webhooks coalesced into this event.",
+    )
+
+    # At most one pending event per payment: repeated webhooks update it in place.
+    _payment_id_pending_uniq = models.UniqueIndex("(payment_id) WHERE state = 'pending'")
+
+    @api.model
+    def _enqueue(self, payment_id, payload, verified=False):
+        """ Store a webhook in the inbox and schedule its processing.
+
+        A webhook for a payment that already has a pending event replaces that
+        event's payload instead of queuing a second one.
+
+        :param str payment_id: The Tabby payment id.
+        :param dict payload: The webhook body.
+        :param bool verified: Whether the webhook was authenticated.
+        """
+        self.env.cr.execute(SQL(
+            """
+            INSERT INTO payment_tabby_webhook
+                (payment_id, payload, verified, state, hits, create_uid, write_uid, create_date, write_date)
+            VALUES (%(payment_id)s, %(payload)s, %(verified)s, 'pending', 1, %(uid)s, %(uid)s,
+                    NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC')
+            ON CONFLICT (payment_id) WHERE state = 'pending'
+            DO UPDATE SET payload = EXCLUDED.payload,
+                          verified = EXCLUDED.verified,
+                          hits = payment_tabby_webhook.hits + 1,
+                          write_uid = EXCLUDED.write_uid,
+                          write_date = EXCLUDED.write_date
+            """,
+            payment_id=payment_id,
+            payload=json.dumps(payload),
+            verified=bool(verified),
+            uid=self.env.uid,
+        ))
+        self.env.ref('payment_tabby.ir_cron_tabby_process_webhooks')._trigger()
+
+    @api.model
+    def _cron_process_webhooks(self):
+        """ Refresh the transactions of the pending webhook events, batch by batch. """
+        events = self.search([('state', '=', 'pending')])
+        _logger.info('Tabby webhook processor. Pending events: %s', len(events))
+
+        deadline = time.monotonic() + const.CRON_TIME_BUDGET
+        for offset in range(0, len(events), const.CRON_BATCH_SIZE):
+            if time.monotonic() >= deadline:
+                self.env.ref('payment_tabby.ir_cron_tabby_process_webhooks')._trigger()
+                break
+            events[offset:offset + const.CRON_BATCH_SIZE]._process_events()
+            self.env.cr.commit()
+
+    def _process_events(self):
+        # Marking the events as processed first lets webhooks received in the
+        # meantime queue a new pending event rather than being swallowed.
+        self.state = 'done'
+
+        txs = self.env['payment.transaction'].search([
+            ('provider_code', '=', 'tabby'),
+            ('provider_reference', 'in', self.mapped('payment_id')),
+        ])
+        known = set(txs.mapped('provider_reference'))
+        for event in self.filtered(lambda e: e.payment_id not in known):
+            DataDog.ddlog(self.env, 'error', 'No transaction found for webhook', data={
+                'payment.id': event.payment_id,
+                'body': event.payload,
+            })
+
+        txs = txs.filtered(lambda tx: tx.state in ['draft', 'pending'])
+
+        # Authenticated webhooks carrying the full payment are applied as is;
+        # the payment of the other transactions is fetched from Tabby.
+        payments = {
+            event.payment_id: self._get_payment_from_payload(event.payload)
+            for event in self if event.verified
+        }
+        with_payment = txs.filtered(lambda tx: payments.get(tx.provider_reference))
+        # Transactions locked by another refresh are left to it.
+        applied = with_payment._tabby_claim(shared=True)
+        for tx in applied:
+            try:
+                with self.env.cr.savepoint():
+                    tx.with_context(tabby_defer_post_process=True)._process(
+                        'tabby', {'type': 'update', 'response': payments[tx.provider_reference]}
+                    )
+            except Exception:
+                _logger.exception('Tabby webhook processor. Failed to update transaction %s.', tx.reference)
+        if applied:
+            self.env.ref('payment.cron_post_process_payment_tx')._trigger()
+        Metrics.inc_shared(self.env, 'tabby_webhook_events_processed_total', {'mode': 'payload'}, len(applied))
+
+        remaining, skipped = (txs - with_payment)._tabby_reconcile()
+        Metrics.inc_shared(
+            self.env, 'tabby_webhook_events_processed_total', {'mode': 'fetch'}, len(txs - with_payment - remaining - skipped),
+        )
+
+        # The events of transactions another process was refreshing are kept
+        # for a later run: that refresh may have fetched the payment before
+        # the update the webhook announced.
+        self._requeue_events((with_payment - applied) | remaining | skipped)
+
+    def _requeue_events(self, txs):
+        """ Put back in the queue the events of the transactions, and schedule the processor again.
+
+        An event is not put back if a newer event for its payment is already
+        pending; that one will refresh the transaction.
+        """
+        events = self.filtered(lambda e: e.payment_id in set(txs.mapped('provider_reference')))
+        if not events:
+            return
+        self.env.flush_all()
+        self.env.cr.execute(SQL(
+            """
+            UPDATE payment_tabby_webhook event
+               SET state = 'pending'
+             WHERE event.id IN %s
+               AND NOT EXISTS (
+                   SELECT 1 FROM payment_tabby_webhook other
+                    WHERE other.payment_id = event.payment_id AND other.state = 'pending'
+               )
+            """,
+            tuple(events.ids),
+        ))
+        events.invalidate_recordset(['state'])
+        self.env.ref('payment_tabby.ir_cron_tabby_process_webhooks')._trigger(
+            fields.Datetime.now() + timedelta(seconds=const.WEBHOOK_REQUEUE_DELAY)
+        )
+
+    @api.model
+    def _get_payment_from_payload(self, payload):
+        """ Return the payment document carried by a webhook payload, if it is complete.
+
+        Webhooks report the status in lower case, unlike the payments API.
+
+        :param dict payload: The webhook body.
+        :return: The payment in the format of the payments API, or None if the
+                 payload lacks any of the values needed to update the transaction.
+        :rtype: dict|None
+        """
+        if not isinstance(payload, dict):
+            return None
+        if not all(payload.get(key) for key in ('status', 'amount', 'currency')):
+            return None
+        if not (payload.get('meta') or {}).get('txref'):
+            return None
+        return dict(payload, status=payload['status'].upper())
+
+    @api.autovacuum
+    def _gc_processed_events(self):
+        self.search([
+            ('state', '=', 'done'),
+            ('write_date', '<', fields.Datetime.now() - timedelta(days=const.WEBHOOK_RETENTION_DAYS)),
+        ]).unlink()
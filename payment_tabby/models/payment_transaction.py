@@ -1,15 +1,127 @@
+import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from . import api as TabbyAPI
+from .dd import DataDog
+from .metrics import Metrics
 from datetime import datetime, timedelta
+from psycopg2.errors import SerializationFailure
 from odoo import api, fields, models, _
+from odoo.exceptions import ValidationError
+from odoo.fields import Command
+from odoo.tools import SQL, split_every
 from werkzeug.urls import url_decode, url_parse
 from .. import const
 
 _logger = logging.getLogger(__name__)
 
+# Provider references recently looked up without result, by (database name,
+# reference), with the monotonic time until which they are considered unknown.
+# Kept per worker.
+_unknown_references = {}
+
+# Orders being pre-scored, or pre-scored without an outcome that could be
+# cached (the buyer has no contact or the call failed), by (database name,
+# order id, amount), with the monotonic time until which they are not
+# pre-scored again. Kept per worker.
+_prescore_attempts = {}
+
+
 class PaymentTransaction(models.Model):
     _inherit = 'payment.transaction'
 
+    tabby_batch_operation = fields.Selection(
+        string="Tabby Batch Operation",
+        selection=[('capture', "Capture"), ('refund', "Refund"), ('void', "Void")],
+        help="The batch operation this transaction is queued for.",
+        index='btree_not_null', copy=False, readonly=True,
+    )
+    tabby_batch_message = fields.Char(
+        string="Tabby Batch Outcome", help="The outcome of the last batch operation.", copy=False, readonly=True,
+    )
+
+    tabby_next_check = fields.Datetime(
+        string="Tabby Next Status Check",
+        help="When the pending transactions cron will next fetch the Tabby status of this transaction.",
+        index='btree_not_null', copy=False, readonly=True,
+    )
+
+    tabby_payment = fields.Json(
+        string="Tabby Payment", help="The last payment document received from Tabby.",
+        copy=False, readonly=True, groups='base.group_system',
+    )
+    tabby_payment_details = fields.Text(
+        string="Tabby Payment Details", compute='_compute_tabby_payment_details', groups='base.group_system',
+    )
+    tabby_payment_status = fields.Char(
+        string="Tabby Payment Status", help="The status of the last payment document received from Tabby.",
+        copy=False, readonly=True,
+    )
+    tabby_payment_fetched_at = fields.Datetime(
+        string="Tabby Payment Received On", copy=False, readonly=True,
+    )
+
+    _tabby_provider_reference_idx = models.Index("(provider_reference) WHERE provider_reference IS NOT NULL")
+
+    def init(self):
+        super().init()
+        # Schedule a check of the transactions left pending before the
+        # polling schedule existed, or they would never be polled again.
+        self.env.cr.execute(SQL(
+            """
+            UPDATE payment_transaction tx
+               SET tabby_next_check = NOW() AT TIME ZONE 'UTC'
+              FROM payment_provider provider
+             WHERE provider.id = tx.provider_id
+               AND provider.code = 'tabby'
+               AND tx.state IN ('draft', 'pending')
+               AND tx.provider_reference IS NOT NULL
+               AND tx.tabby_next_check IS NULL
+            """
+        ))
+
+    @api.depends('tabby_payment')
+    def _compute_tabby_payment_details(self):
+        for tx in self:
+            tx.tabby_payment_details = tx.tabby_payment and json.dumps(tx.tabby_payment, indent=2, sort_keys=True)
+
+    @api.model
+    def _tabby_is_unknown_reference(self, reference):
+        """ Return whether the reference recently matched no transaction. """
+        expiry = _unknown_references.get((self.env.cr.dbname, reference))
+        return expiry is not None and expiry > time.monotonic()
+
+    @api.model
+    def _tabby_get_tx_from_provider_reference(self, reference, log_message=None, log_data=None):
+        """ Find the transaction of a Tabby payment id.
+
+        References that matched nothing are remembered for a short while so that
+        repeated unknown or foreign payment ids are rejected without a search,
+        and logged once per period.
+
+        :param str reference: The Tabby payment id.
+        :param str log_message: The message logged to Datadog when the search finds nothing.
+        :param dict log_data: The data logged with the message.
+        :return: The transaction, if found.
+        :rtype: recordset of `payment.transaction`
+        """
+        if not reference or self._tabby_is_unknown_reference(reference):
+            return self.browse()
+        tx = self.search([('provider_reference', '=', reference)], limit=1)
+        if not tx:
+            if log_message:
+                DataDog.ddlog(self.env, 'error', log_message, data=log_data)
+            now = time.monotonic()
+            if len(_unknown_references) >= const.UNKNOWN_REFERENCE_CACHE_SIZE:
+                for key, expiry in list(_unknown_references.items()):
+                    if expiry <= now:
+                        _unknown_references.pop(key, None)
+                if len(_unknown_references) >= const.UNKNOWN_REFERENCE_CACHE_SIZE:
+                    _unknown_references.clear()
+            _unknown_references[self.env.cr.dbname, reference] = now + const.UNKNOWN_REFERENCE_TTL
+        return tx
+
     def _get_specific_rendering_values(self, processing_values):
         """ Return Tabby redirect URL for template rendering. """
         res = super()._get_specific_rendering_values(processing_values)
@@ -17,7 +129,15 @@ class PaymentTransaction(models.Model):
         if self.provider_code != 'tabby':
             return res
 
-        session = self._tabby_create_session(processing_values)
+        # A buyer Tabby rejected moments ago is not sent through a new session.
+        order = self.sale_order_ids[:1]
+        eligibility = self.env['payment.tabby.eligibility'].sudo()
+        if order and eligibility._lookup(order.partner_id, order.currency_id, order.amount_total) is False:
+            session = None
+        else:
+            session = self._tabby_create_session(processing_values)
+            if order:
+                eligibility._record(order.partner_id, order.currency_id, order.amount_total, session)
 
         if isinstance(session, dict) and session.get('status') == 'created':
             res['is_available'] = True
@@ -28,7 +148,9 @@ class PaymentTransaction(models.Model):
             res['params'] = params
 
             self.provider_reference = session.get('payment', {}).get('id', None)
+            _unknown_references.pop((self.env.cr.dbname, self.provider_reference), None)
             self._set_pending()
+            self._tabby_schedule_next_check()
         else:
             res['is_available'] = False
             res['api_url'] = None
@@ -43,9 +165,88 @@ class PaymentTransaction(models.Model):
         return api.createSession(self._get_tabby_session_data(processing_values))
 
     def _get_tabby_session_data(self, processing_values):
-        """ Prepare data for Tabby session creation. """
+        """ Prepare data for Tabby session creation.
+
+        The payload only depends on the order, so it is reused across payment
+        attempts until the order, its lines or its partners change; only the
+        transaction reference is set for each attempt.
+        """
         order = self.sale_order_ids[:1]
-        lang = self.env.context.get('lang')[:2]
+        data = self._tabby_get_order_session_data(order)
+        data['payment']['meta']['txref'] = str(self.reference)
+        return data
+
+    def _tabby_get_order_session_data(self, order):
+        key = order._tabby_get_session_cache_key(self.env.context.get('lang'))
+        data = order._tabby_get_cached_session_data(key)
+        if data is None:
+            data = self._tabby_build_session_data(order)
+            order._tabby_set_cached_session_data(key, data)
+        return data
+
+    @api.model
+    def _tabby_prepare_session_data(self, provider, order):
+        """ Build and cache the session payload of an order ahead of the payment attempt.
+
+        :param recordset provider: The Tabby provider, as a `payment.provider` record.
+        :param recordset order: The order being paid, as a `sale.order` record.
+        :return: The session payload, or None if Tabby does not support the order.
+        :rtype: dict|None
+        """
+        tx = self.new({
+            'provider_id': provider.id,
+            'currency_id': order.currency_id.id,
+            'sale_order_ids': [Command.set(order.ids)],
+        })
+        try:
+            return tx._tabby_get_order_session_data(order)
+        except ValidationError as e:
+            _logger.info('Tabby session payload of order %s not prepared: %s', order.name, e)
+            return None
+
+    @api.model
+    def _tabby_prescore(self, provider, order):
+        """ Check whether Tabby accepts the buyer of an order before the payment attempt.
+
+        The session payload of the order is always prepared, so that the
+        payment attempt reuses it. A session is created with it unless the
+        outcome for the buyer, currency and amount is already known; the
+        outcome is then remembered for the payment attempt and the payment form.
+
+        :param recordset provider: The Tabby provider, as a `payment.provider` record.
+        :param recordset order: The order being paid, as a `sale.order` record.
+        :return: Whether the buyer is eligible, or None if it could not be determined.
+        :rtype: bool|None
+        """
+        data = self._tabby_prepare_session_data(provider, order)
+        if not data:
+            return None
+
+        eligibility = self.env['payment.tabby.eligibility']
+        eligible = eligibility._lookup(order.partner_id, order.currency_id, order.amount_total)
+        if eligible is not None:
+            return eligible
+
+        # Without this guard, each page load would create a new session for
+        # buyers whose outcome is not cached.
+        now = time.monotonic()
+        attempt = (self.env.cr.dbname, order.id, order.amount_total)
+        if _prescore_attempts.get(attempt, 0) > now:
+            return None
+        if len(_prescore_attempts) >= const.PRESCORE_GUARD_SIZE:
+            for key, expiry in list(_prescore_attempts.items()):
+                if expiry <= now:
+                    _prescore_attempts.pop(key, None)
+            if len(_prescore_attempts) >= const.PRESCORE_GUARD_SIZE:
+                _prescore_attempts.clear()
+        _prescore_attempts[attempt] = now + const.PRESCORE_RETRY_DELAY
+
+        data = dict(data, payment=dict(data['payment'], meta=dict(data['payment']['meta'], txref=None)))
+        session = TabbyAPI.TabbyAPI(provider=provider, country_code=data['merchant_code']).createSession(data)
+        return eligibility._record(order.partner_id, order.currency_id, order.amount_total, session)
+
+    def _tabby_build_session_data(self, order):
+        lang = (self.env.context.get('lang') or 'en')[:2]
         return {
             'lang': lang if lang in ['en', 'ar'] else 'en',
             'merchant_code': self.provider_id.get_merchant_code_from_currency(order.currency_id.name),
@@ -105,30 +306,69 @@ class PaymentTransaction(models.Model):
 
         return phones + emails
 
-    def get_customer_loyality_level(self, order):
-        contacts = self.get_sale_order_contacts(order)
+    def _tabby_get_buyer_partners(self, order):
+        """ Return the partners sharing an email or a phone number with the contacts of the order.
 
+        The partners are looked up in the normalized contact keys, so that the
+        past orders are then selected on their indexed partner.
+        """
+        partners = order.partner_id | order.partner_invoice_id | order.partner_shipping_id
+        return self.env['payment.tabby.contact'].sudo()._get_partners(partners)
+
+    def get_customer_loyality_level(self, order):
         return self.env['sale.order'].search_count([
             ('state', 'in', ['sale', 'done']),
-            '|',
-            ('partner_id.email', 'in', contacts),
-            ('partner_id.phone', 'in', contacts),
+            ('partner_id', 'in', self._tabby_get_buyer_partners(order).ids),
         ])
 
     def get_order_history_object(self, order):
-        contacts = self.get_sale_order_contacts(order)
         domain = [
             ('state', 'in', const.ORDER_STATE_MAP.keys()),
-            '|',
-            ('partner_id.email', 'in', contacts),
-            ('partner_id.phone', 'in', contacts),
+            ('partner_id', 'in', self._tabby_get_buyer_partners(order).ids),
         ]
 
         ho = self.env['sale.order'].search(domain, limit=10, order='date_order desc')
+        ho = ho.filtered(lambda o: const.ORDER_STATE_MAP.get(o.state))
+        refunded = self._tabby_prefetch_order_history(ho)
+
+        return [self.get_order_history_order_object(o, refunded=refunded) for o in ho]
+
+    def _tabby_prefetch_order_history(self, orders):
+        """ Load everything the order history payload reads in a fixed number of queries.
 
-        return [self.get_order_history_order_object(o) for o in ho if const.ORDER_STATE_MAP.get(o.state)]
+        The orders, their partners, last transactions, lines and products are
+        fetched in bulk into the cache; the refunded quantities are aggregated
+        in a single query.
+
+        :param recordset orders: The past orders, as a `sale.order` recordset.
+        :return: The refunded quantity of each order line, by line id.
+        :rtype: dict
+        """
+        if not orders:
+            return {}
+        orders.fetch(['name', 'currency_id', 'amount_total', 'date_order', 'state', 'partner_id', 'partner_shipping_id'])
+        (orders.partner_id | orders.partner_shipping_id).fetch(
+            ['name', 'email', 'phone', 'street', 'street2', 'city', 'zip']
+        )
+        transactions = orders.transaction_ids.sudo()
+        transactions.fetch(['state', 'provider_id', 'payment_method_id'])
+        transactions.provider_id.fetch(['name'])
+        transactions.payment_method_id.fetch(['name'])
+        lines = orders.order_line
+        lines.fetch(['order_id', 'product_id', 'is_delivery', 'product_uom_qty', 'price_total', 'qty_invoiced', 'qty_delivered'])
+        lines.product_id.fetch(['name', 'default_code'])
+        refunds = self.env['account.move.line'].sudo()._read_group(
+            [
+                ('sale_line_ids', 'in', lines.ids),
+                ('move_id.move_type', '=', 'out_refund'),
+                ('move_id.state', '=', 'posted'),
+            ],
+            ['sale_line_ids'],
+            ['quantity:sum'],
+        )
+        return {line.id: quantity for line, quantity in refunds}
 
-    def get_order_history_order_object(self, order):
+    def get_order_history_order_object(self, order, refunded=None):
         transaction = order.get_portal_last_transaction()
         provider_name = transaction.provider_id.name if transaction else "cod"
         return {
@@ -138,12 +378,29 @@ class PaymentTransaction(models.Model):
             'status': const.ORDER_STATE_MAP.get(order.state),
             'buyer': self.get_buyer_object(order),
             'shipping_address': self.get_shipping_address_object(order),
-            'items': self.get_order_history_order_items_object(order),
+            'items': self.get_order_history_order_items_object(order, refunded=refunded),
         }
-    def get_order_history_order_items_object(self, order):
-        return [self.get_order_history_order_item_object(line) for line in order.order_line if line.product_id and not line.is_delivery]
+    def get_order_history_order_items_object(self, order, refunded=None):
+        return [
+            self.get_order_history_order_item_object(line, refunded=refunded)
+            for line in order.order_line if line.product_id and not line.is_delivery
+        ]
 
-    def get_order_history_order_item_object(self, line):
+    def get_order_history_order_item_object(self, line, refunded=None):
+        """ Prepare an order history item.
+
+        :param dict refunded: The refunded quantities by line id, as returned by
+                              `_tabby_prefetch_order_history`. Computed from the
+                              line's invoice lines when not given.
+        """
+        if refunded is None:
+            refunded_qty = sum(
+                inv_line.quantity
+                for inv_line in line.invoice_lines
+                if inv_line.move_id.move_type == 'out_refund' and inv_line.move_id.state == 'posted'
+            )
+        else:
+            refunded_qty = refunded.get(line.id, 0)
         return {
             'quantity': int(line.product_uom_qty),
             'title': line.product_id.name,
@@ -152,11 +409,7 @@ class PaymentTransaction(models.Model):
             'ordered': int(line.product_uom_qty),
             'captured': int(line.qty_invoiced),
             'shipped': int(line.qty_delivered) if hasattr(line, 'qty_delivered') else 0,
-            'refunded': int(sum(
-                inv_line.quantity
-                for inv_line in line.invoice_lines
-                if inv_line.move_id.move_type == 'out_refund' and inv_line.move_id.state == 'posted'
-            )),
+            'refunded': int(refunded_qty),
         }
 
     def _get_tabby_item_unit_price(self, line):
@@ -173,48 +426,86 @@ class PaymentTransaction(models.Model):
         order = self.sale_order_ids[:1]
         if (not order):
             return {}
+        snapshot = self._tabby_get_order_snapshot(order)
         return {
             'reference_id': str(order.name),
-            'shipping_amount': str(self.get_shipping_amount(order)),
-            'discount_amount': str(self.get_discount_amount(order)),
-            'tax_amount': str(order.amount_tax),
-            'items': self.get_order_items(order),
+            'shipping_amount': str(snapshot['shipping_amount']),
+            'discount_amount': str(snapshot['discount_amount']),
+            'tax_amount': str(snapshot['tax_amount']),
+            'items': self._tabby_get_session_items(snapshot),
         }
-    def get_shipping_amount(self, order):
-        delivery_line = order.order_line.filtered(lambda l: l.is_delivery)
-        if delivery_line:
-            # price_total includes all applied taxes
-            return sum(delivery_line.mapped('price_total'))
-        return 0.0
-
-    def get_discount_amount(self, order):
-        total_discount = 0.0
-        for line in order.order_line:
-            # Calculate: (Unit Price * Quantity) - Subtotal
-            # This gives the raw discount amount before taxes
-            line_discount = (line.price_unit * line.product_uom_qty) - line.price_subtotal
-            total_discount += line_discount
-        return total_discount
 
-    def get_order_items(self, order):
-        """ Prepare order items for Tabby API. """
+    def _tabby_get_order_snapshot(self, order):
+        """ Collect what the session and capture payloads need from the order in one pass over its lines.
+
+        :param recordset order: The order, as a `sale.order` record.
+        :return: The `items` (one per product line, with the values of both
+                 payloads) and the `shipping_amount`, `discount_amount` and
+                 `tax_amount` of the order.
+        :rtype: dict
+        """
+        lines = order.order_line
+        lines.fetch(['name', 'product_id', 'is_delivery', 'price_unit', 'product_uom_qty', 'price_subtotal', 'price_total'])
+        lines.product_id.fetch(['default_code', 'categ_id'])
+        base_url = self.provider_id._tabby_get_base_url()
+
+        shipping_amount = 0.0
+        discount_amount = 0.0
         items = []
-        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
-        for line in order.order_line:
-            if not line.product_id or line.is_delivery:
+        for line in lines:
+            # (Unit Price * Quantity) - Subtotal is the raw discount amount before taxes
+            discount_amount += (line.price_unit * line.product_uom_qty) - line.price_subtotal
+            if line.is_delivery:
+                # price_total includes all applied taxes
+                shipping_amount += line.price_total
                 continue
-            item = {
+            if not line.product_id:
+                continue
+            product = line.product_id
+            items.append({
                 'title': line.name,
+                'display_name': line.display_name,
+                'description': line.name,
                 'quantity': int(line.product_uom_qty),
                 'unit_price': self._get_tabby_item_unit_price(line),
                 'reference_id': self._get_tabby_item_reference_id(line),
-                'description': line.name,
-                'image_url': f"{base_url}/web/image?model=product.product&id={line.product_id.id}&field=image_1920",
-                'product_url': f"{base_url}/{line.product_id.website_url}",
-                'category': str(line.product_id.categ_id.name or 'Uncategorized'),
-            }
-            items.append(item)
-        return items
+                'image_url': f"{base_url}/web/image?model=product.product&id={product.id}&field=image_1920",
+                'product_url': f"{base_url}/{product.website_url}",
+                'category': str(product.categ_id.name or 'Uncategorized'),
+            })
+        return {
+            'shipping_amount': shipping_amount,
+            'discount_amount': discount_amount,
+            'tax_amount': order.amount_tax,
+            'items': items,
+        }
+
+    def _tabby_get_session_items(self, snapshot):
+        return [
+            {key: value for key, value in item.items() if key != 'display_name'}
+            for item in snapshot['items']
+        ]
+
+    def _tabby_get_capture_items(self, snapshot):
+        return [
+            {
+                'title': item['display_name'],
+                'description': item['description'],
+                'quantity': item['quantity'],
+                'unit_price': item['unit_price'],
+                'reference_id': item['reference_id'],
+            } for item in snapshot['items']
+        ]
+
+    def get_shipping_amount(self, order):
+        return self._tabby_get_order_snapshot(order)['shipping_amount']
+
+    def get_discount_amount(self, order):
+        return self._tabby_get_order_snapshot(order)['discount_amount']
+
+    def get_order_items(self, order):
+        """ Prepare order items for Tabby API. """
+        return self._tabby_get_session_items(self._tabby_get_order_snapshot(order))
 
     def _send_capture_request(self):
         if self.provider_code != 'tabby':
@@ -222,14 +513,8 @@ class PaymentTransaction(models.Model):
 
         self.ensure_one()
 
-        api = TabbyAPI.TabbyAPI(provider=self.provider_id, transaction=self)
-
-        response = api.capture(
-            self.source_transaction_id.provider_reference if self.source_transaction_id else self.provider_reference,
-            self._get_tabby_capture_data()
-        )
-
-        self._process('tabby', {'type': 'capture', 'response': response})
+        call, args = self._tabby_prepare_operation('capture')
+        self._process('tabby', {'type': 'capture', 'response': call(*args)})
 
     def _get_tabby_capture_data(self):
         if self.reference != self.source_transaction_id.reference:
@@ -238,71 +523,258 @@ class PaymentTransaction(models.Model):
                 'reference_id': str(self.reference),
             }
         order = self.source_transaction_id.sale_order_ids[:1]
+        snapshot = self._tabby_get_order_snapshot(order)
         return {
             'amount': str(round(self.amount, self.currency_id.decimal_places)),
-            'tax_amount': str(order.amount_tax),
-            'shipping_amount': str(self.get_shipping_amount(order)),
+            'tax_amount': str(snapshot['tax_amount']),
+            'shipping_amount': str(snapshot['shipping_amount']),
             'reference_id': str(self.reference),
-            'items': [
-                {
-                    'title': line.display_name,
-                    'description': line.name,
-                    'quantity': int(line.product_uom_qty),
-                    'unit_price': self._get_tabby_item_unit_price(line),
-                    'reference_id': self._get_tabby_item_reference_id(line)
-                } for line in order.order_line if line.product_id and not line.is_delivery
-            ]
+            'items': self._tabby_get_capture_items(snapshot),
         }
 
     def _send_refund_request(self, amount_to_refund=None):
         if self.provider_code != 'tabby':
             return super()._send_refund_request(amount_to_refund=amount_to_refund)
-        auth_txn = self.source_transaction_id
 
-        if auth_txn.source_transaction_id:
-            auth_txn = auth_txn.source_transaction_id
+        self.ensure_one()
 
-        if not auth_txn.provider_reference:
-            raise ValidationError(_("No Tabby payment ID found for this transaction."))
+        call, args = self._tabby_prepare_operation('refund', amount_to_refund=amount_to_refund)
+        self._process('tabby', {'type': 'refund', 'response': call(*args)})
 
-        refund_amount = abs(amount_to_refund or self.amount)
+    def _send_void_request(self):
+        if self.provider_code != 'tabby':
+            return super()._send_void_request()
 
         self.ensure_one()
 
-        api = TabbyAPI.TabbyAPI(provider=self.provider_id, transaction=self)
+        call, args = self._tabby_prepare_operation('void')
+        self._process('tabby', {'type': 'void', 'response': call(*args)})
 
-        response = api.refund(
-            auth_txn.provider_reference,
-            {
-                'amount': str(refund_amount),
-                'reason': f"Refund transaction {self.reference}",
-                'reference_id': str(self.reference),
-            }
-        )
+    def _tabby_prepare_operation(self, operation, amount_to_refund=None):
+        """ Prepare the Tabby API call of a capture, refund or void.
 
-        self._process('tabby', {'type': 'refund', 'response': response});
+        The call itself does not use the cursor, so that batches can run it in
+        worker threads.
 
-    def _send_void_request(self):
-        if self.provider_code != 'tabby':
-            return super()._send_refund_request(amount_to_refund=amount_to_refund)
+        :param str operation: The operation: `capture`, `refund` or `void`.
+        :param float amount_to_refund: The amount to refund, for refunds.
+        :return: The API method to call and its arguments.
+        :rtype: tuple
+        """
+        self.ensure_one()
+        api = TabbyAPI.TabbyAPI(provider=self.provider_id, transaction=self)
+
+        if operation == 'capture':
+            return api.capture, (
+                self.source_transaction_id.provider_reference if self.source_transaction_id else self.provider_reference,
+                self._get_tabby_capture_data(),
+            )
+
+        if operation == 'refund':
+            auth_txn = self.source_transaction_id
+            if auth_txn.source_transaction_id:
+                auth_txn = auth_txn.source_transaction_id
+            if not auth_txn.provider_reference:
+                raise ValidationError(_("No Tabby payment ID found for this transaction."))
+            return api.refund, (
+                auth_txn.provider_reference,
+                {
+                    'amount': str(abs(amount_to_refund or self.amount)),
+                    'reason': f"Refund transaction {self.reference}",
+                    'reference_id': str(self.reference),
+                },
+            )
 
-        if not self.source_transaction_id.provider_reference:
+        payment_id = (self.source_transaction_id or self).provider_reference
+        if not payment_id:
             raise ValidationError(_("No Tabby payment ID found for this transaction."))
+        return api.close, (payment_id,)
 
-        self.ensure_one()
+    #=== BATCH OPERATIONS ===#
 
-        api = TabbyAPI.TabbyAPI(provider=self.provider_id, transaction=self)
+    def action_tabby_batch_capture(self):
+        return self._tabby_queue_batch_operation(
+            'capture', self.filtered(lambda tx: tx.provider_code == 'tabby' and tx.state == 'authorized')
+        )
+
+    def action_tabby_batch_void(self):
+        return self._tabby_queue_batch_operation(
+            'void', self.filtered(lambda tx: tx.provider_code == 'tabby' and tx.state == 'authorized')
+        )
 
-        response = api.close(self.source_transaction_id.provider_reference)
+    def action_tabby_batch_refund(self):
+        refund_txs = self.browse()
+        for tx in self.filtered(lambda tx: tx.provider_code == 'tabby' and tx.state == 'done' and tx.operation != 'refund'):
+            # Queued and sent refunds are counted; refunds that failed without an
+            # error state stay in draft, out of the queue, and are not.
+            refunded = sum(tx.child_transaction_ids.filtered(
+                lambda child: child.operation == 'refund' and (
+                    child.state in ('pending', 'done')
+                    or (child.state == 'draft' and child.tabby_batch_operation == 'refund')
+                )
+            ).mapped('amount'))
+            amount_to_refund = tx.amount + refunded  # Refunds have negative amounts.
+            if tx.currency_id.compare_amounts(amount_to_refund, 0) > 0:
+                refund_txs |= tx._create_child_transaction(amount_to_refund, is_refund=True)
+        return self._tabby_queue_batch_operation('refund', refund_txs)
+
+    def _tabby_queue_batch_operation(self, operation, txs):
+        """ Queue the transactions for a batch operation run in the background.
+
+        The queue is persisted on the transactions so that a batch interrupted
+        by a crash resumes on the next run of the batch operations cron.
+
+        :param str operation: The operation: `capture`, `refund` or `void`.
+        :param recordset txs: The transactions to process, as a `payment.transaction` recordset.
+        :return: A notification action.
+        :rtype: dict
+        """
+        txs.write({'tabby_batch_operation': operation, 'tabby_batch_message': False})
+        self.env.ref('payment_tabby.ir_cron_tabby_batch_operations')._trigger()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'type': 'info',
+                'title': _("Tabby"),
+                'message': _(
+                    "%(count)s transactions queued for %(operation)s. The outcome of each transaction "
+                    "is shown in its Tabby Batch Outcome field.",
+                    count=len(txs),
+                    operation=dict(self._fields['tabby_batch_operation']._description_selection(self.env))[operation],
+                ),
+                'sticky': False,
+            },
+        }
 
-        self._process('tabby', {'type': 'void', 'response': response});
+    @api.model
+    def _cron_tabby_batch_operations(self):
+        txs = self.search([('tabby_batch_operation', '!=', False)], order='id')
+        _logger.info('Tabby batch operations. Queued transactions: %s', len(txs))
+
+        deadline = time.monotonic() + const.CRON_TIME_BUDGET
+        for batch in split_every(const.CRON_BATCH_SIZE, txs.ids, self.browse):
+            if time.monotonic() >= deadline:
+                self.env.ref('payment_tabby.ir_cron_tabby_batch_operations')._trigger()
+                break
+            batch._tabby_run_batch_operations()
+            self.env.cr.commit()
+
+    def _tabby_run_batch_operations(self):
+        """ Send the queued operations of the transactions concurrently and process the results in bulk.
+
+        The API calls run in a bounded thread pool; their results are then
+        processed one by one on the current cursor and the outcome of each
+        transaction is recorded on it. The API clients are built in the calling
+        thread, so that the worker threads never use the cursor.
+        """
+        calls = []
+        for tx in self:
+            try:
+                calls.append((tx, *tx._tabby_prepare_operation(tx.tabby_batch_operation)))
+            except ValidationError as e:
+                tx.write({'tabby_batch_operation': False, 'tabby_batch_message': str(e)})
+        if not calls:
+            return
+
+        def send(call, args):
+            try:
+                return call(*args)
+            except Exception as e:
+                _logger.exception('Tabby batch operations. API call failed.')
+                return {'status': 'error', 'message': str(e)}
+
+        with ThreadPoolExecutor(max_workers=min(const.BATCH_OPERATION_WORKERS, len(calls))) as executor:
+            futures = [(tx, executor.submit(send, call, args)) for tx, call, args in calls]
+
+        expected_states = {'capture': 'done', 'refund': 'done', 'void': 'cancel'}
+        for tx, future in futures:
+            operation = tx.tabby_batch_operation
+            response = future.result()
+            try:
+                with self.env.cr.savepoint():
+                    tx.with_context(tabby_defer_post_process=True)._process(
+                        'tabby', {'type': operation, 'response': response}
+                    )
+            except Exception as e:
+                _logger.exception('Tabby batch operations. Failed to process transaction %s.', tx.reference)
+                message = str(e)
+            else:
+                if tx.state == expected_states[operation]:
+                    message = _("%s succeeded", operation.capitalize())
+                else:
+                    message = response.get('message') or tx.state_message or _("%s failed", operation.capitalize())
+                    if operation == 'refund' and tx.state == 'draft':
+                        # The refund was not made; close its child transaction.
+                        tx._set_error(message)
+            tx.write({'tabby_batch_operation': False, 'tabby_batch_message': message})
+        self.env.ref('payment.cron_post_process_payment_tx')._trigger()
 
     def _tabby_update_payment_status(self):
-        """ Retrieve payment status from Tabby API. """
+        """ Retrieve payment status from Tabby API.
+
+        Nothing is done if another process is already refreshing the transaction.
+        """
+        if not self._tabby_claim():
+            _logger.info('Transaction %s is already being refreshed, skipping.', self.reference)
+            return False
         api = TabbyAPI.TabbyAPI(provider=self.provider_id, transaction=self)
         payment = api.get_payment(self.provider_reference)
         return self._process('tabby', {'type': 'update', 'response': payment})
 
+    def _tabby_store_payment(self, payment):
+        """ Store a payment document received from Tabby on the transaction. """
+        if not isinstance(payment, dict) or not payment.get('id') or payment.get('status') in (None, 'error'):
+            return
+        self.sudo().write({
+            'tabby_payment': payment,
+            'tabby_payment_status': payment['status'],
+            'tabby_payment_fetched_at': fields.Datetime.now(),
+        })
+
+    def _tabby_claim(self, shared=False):
+        """ Lock the transactions for a status refresh, skipping those another process holds.
+
+        The success redirect, the webhook processor and the pending transactions
+        cron can refresh the same transaction at once. Only the process holding
+        the row lock fetches and applies the payment; the others skip it and see
+        its outcome once the holder commits. The lock is released at the end of
+        the current transaction.
+
+        :param bool shared: Whether to count the claims in the shared metrics,
+                            as the crons do, rather than in this worker's.
+        :return: The transactions locked by the current transaction.
+        :rtype: recordset of `payment.transaction`
+        """
+        claimed = self._tabby_lock_for_refresh()
+        if shared:
+            Metrics.inc_shared(self.env, 'tabby_status_refreshes_total', {'outcome': 'claimed'}, len(claimed))
+            Metrics.inc_shared(self.env, 'tabby_status_refreshes_total', {'outcome': 'skipped'}, len(self - claimed))
+        else:
+            Metrics.inc('tabby_status_refreshes_total', {'outcome': 'claimed'}, len(claimed))
+            Metrics.inc('tabby_status_refreshes_total', {'outcome': 'skipped'}, len(self - claimed))
+        return claimed
+
+    def _tabby_lock_for_refresh(self):
+        if not self:
+            return self
+        try:
+            with self.env.cr.savepoint():
+                rows = self.env.execute_query(SQL(
+                    "SELECT id FROM payment_transaction WHERE id IN %s FOR UPDATE SKIP LOCKED",
+                    tuple(self.ids),
+                ))
+        except SerializationFailure:
+            # A row was updated and committed since this transaction started:
+            # its holder has already refreshed it. Claim the others one by one.
+            if len(self) == 1:
+                claimed = self.browse()
+            else:
+                claimed = self.browse().union(*(tx._tabby_lock_for_refresh() for tx in self))
+        else:
+            claimed = self.browse(row[0] for row in rows)
+        return claimed
+
     def _extract_amount_data(self, data):
         """ Override of `payment` to extract Tabby payment data. """
         if self.provider_code != 'tabby':
@@ -348,11 +820,12 @@ class PaymentTransaction(models.Model):
             return super()._apply_updates(payment_data)
 
         payment = payment_data.get('response')
+        self._tabby_store_payment(payment)
 
         if payment_data.get('type') == 'void':
             if payment.get('status') == 'CLOSED':
                 self._set_canceled();
-                self.env.ref('payment.cron_post_process_payment_tx')._trigger()
+                self._tabby_trigger_post_process()
                 return True
 
         if payment_data.get('type') == 'refund':
@@ -362,7 +835,7 @@ class PaymentTransaction(models.Model):
                     return False
                 self.provider_reference = refunds[0].get('id')
                 self._set_done()
-                self.env.ref('payment.cron_post_process_payment_tx')._trigger()
+                self._tabby_trigger_post_process()
                 return True
 
         if payment_data.get('type') == 'capture':
@@ -373,12 +846,13 @@ class PaymentTransaction(models.Model):
                 if not self.provider_reference:
                     self.provider_reference = captures[0].get('id')
                 self._set_done()
-                self.env.ref('payment.cron_post_process_payment_tx')._trigger()
+                self._tabby_trigger_post_process()
                 return True
 
         status = payment.get('status')
         if status == 'error':
             _logger.error('Transaction %s not changed due to Tabby API error response.', self.reference)
+            self._tabby_schedule_next_check()
             return False
         if status == 'CREATED':
             if self.state == 'draft':
@@ -394,28 +868,143 @@ class PaymentTransaction(models.Model):
             if self.state in ['draft', 'pending', 'authorized']:
                 self._set_done()
                 _logger.info('Transaction %s marked as done.', self.reference)
-                self.env.ref('payment.cron_post_process_payment_tx')._trigger()
+                self._tabby_trigger_post_process()
         elif status == 'REJECTED':
             self._set_error()
             _logger.info('Transaction %s marked as rejected.', self.reference)
         else:
             self._set_error()
             _logger.error('Transaction %s marked as error due to unknown status: %s', self.reference, status)
+        self._tabby_schedule_next_check()
         return True
 
+    def _tabby_schedule_next_check(self):
+        """ Schedule the next status check of the transaction, counted from now.
+
+        The interval grows with the age of the transaction, so that the checks
+        back off exponentially while it is in the polling window. Older
+        transactions get a single long-tail check, after which, as for
+        transactions that are no longer draft or pending, no check is scheduled.
+        """
+        self.ensure_one()
+        now = fields.Datetime.now()
+        next_check = False
+        if self.state in ('draft', 'pending') and self.provider_reference:
+            age = now - (self.create_date or now)
+            long_tail = (self.create_date or now) + timedelta(seconds=const.POLL_LONG_TAIL)
+            if age < timedelta(seconds=const.POLL_WINDOW):
+                next_check = min(now + max(timedelta(seconds=const.POLL_MIN_INTERVAL), age), long_tail)
+            elif now < long_tail:
+                next_check = long_tail
+        if self.tabby_next_check != next_check:
+            self.tabby_next_check = next_check
+
+    def _tabby_trigger_post_process(self):
+        """ Trigger the post-processing cron, unless the caller batches the triggers itself. """
+        if not self.env.context.get('tabby_defer_post_process'):
+            self.env.ref('payment.cron_post_process_payment_tx')._trigger()
+
     @api.model
     def _cron_tabby_check_pending(self):
-        time_limit = fields.Datetime.now() - timedelta(minutes=30)
+        # Only the transactions whose check is due are selected; checking one
+        # schedules its next check, or none once it leaves draft and pending.
         txs = self.search([
+            ('tabby_next_check', '<=', fields.Datetime.now()),
             ('provider_code', '=', 'tabby'),
             ('state', 'in', ['draft', 'pending']),
-            ('create_date', '>=', time_limit)
-        ])
+        ], order='tabby_next_check asc')
 
         _logger.info('Tabby cron. Total transactions: %s', len(txs))
 
-        for tx in txs:
-            txs._tabby_update_payment_status()
+        start = time.monotonic()
+        remaining, _skipped = txs._tabby_reconcile(time_budget=const.CRON_TIME_BUDGET)
+        Metrics.set_shared(self.env, 'tabby_cron_transactions', len(txs))
+        Metrics.set_shared(self.env, 'tabby_cron_remaining_transactions', len(remaining))
+        Metrics.set_shared(self.env, 'tabby_cron_duration_seconds', time.monotonic() - start)
+        if remaining:
+            _logger.info('Tabby cron. Time budget exhausted, %s transactions left for the next run.', len(remaining))
+            self.env.ref('payment_tabby.ir_cron_tabby_check_pending')._trigger()
+
+    @api.model
+    def _tabby_update_backlog_metrics(self):
+        """ Refresh the backlog gauges, which a scrape may not find in the worker running the crons. """
+        Metrics.set('tabby_pending_transactions', self.search_count([
+            ('provider_code', '=', 'tabby'),
+            ('state', 'in', ['draft', 'pending']),
+            ('provider_reference', '!=', False),
+        ]))
+        Metrics.set('tabby_pending_webhook_events', self.env['payment.tabby.webhook'].search_count([
+            ('state', '=', 'pending'),
+        ]))
+        stats = DataDog.get_stats()
+        Metrics.set('tabby_datadog_queue_depth', stats.pop('queue_depth'))
+        for outcome, count in stats.items():
+            Metrics.set('tabby_datadog_entries_total', count, {'outcome': outcome})
+
+    def _tabby_reconcile(self, time_budget=None):
+        """ Refresh the Tabby status of the transactions in batches.
+
+        The payments of a batch are fetched concurrently, then applied one by one
+        on the current cursor, which is committed after each batch. The payment
+        post-processing cron is triggered once per batch.
+
+        :param float time_budget: The number of seconds after which no new batch is started.
+        :return: The transactions left unprocessed for lack of time, and those
+                 skipped because another process was refreshing them.
+        :rtype: tuple
+        """
+        deadline = time.monotonic() + time_budget if time_budget else None
+        remaining = self
+        skipped = self.browse()
+        for batch in split_every(const.CRON_BATCH_SIZE, self.ids, self.browse):
+            if deadline and time.monotonic() >= deadline:
+                break
+            remaining -= batch
+            claimed = batch._tabby_claim(shared=True)
+            skipped |= batch - claimed
+            batch = claimed
+            states = {tx.id: tx.state for tx in batch}
+            for tx, payment in batch.with_context(tabby_defer_post_process=True)._tabby_fetch_payments():
+                try:
+                    with self.env.cr.savepoint():
+                        tx._process('tabby', {'type': 'update', 'response': payment})
+                except Exception:
+                    _logger.exception('Tabby cron. Failed to update transaction %s.', tx.reference)
+                    tx._tabby_schedule_next_check()
+            if any(tx.state != states[tx.id] for tx in batch):
+                self.env.ref('payment.cron_post_process_payment_tx')._trigger()
+            self.env.cr.commit()
+        return remaining, skipped
+
+    def _tabby_fetch_payments(self):
+        """ Fetch the Tabby payment of every transaction with a bounded thread pool.
+
+        Only the HTTP calls run in the pool: the API clients, and the log
+        metadata they carry, are built in the calling thread, so that the
+        worker threads never use the cursor.
+
+        :return: The list of (transaction, payment) pairs.
+        :rtype: list
+        """
+        calls = []
+        for tx in self:
+            try:
+                calls.append((tx, TabbyAPI.TabbyAPI(provider=tx.provider_id, transaction=tx)))
+            except ValidationError as e:
+                _logger.warning('Tabby cron. Skipping transaction %s: %s', tx.reference, e)
+        if not calls:
+            return []
+
+        def fetch(api, reference):
+            try:
+                return api.get_payment(reference)
+            except Exception as e:
+                _logger.exception('Tabby cron. Failed to fetch payment %s.', reference)
+                return {'status': 'error', 'message': str(e)}
+
+        with ThreadPoolExecutor(max_workers=min(const.CRON_FETCH_WORKERS, len(calls))) as executor:
+            futures = [(tx, executor.submit(fetch, api, tx.provider_reference)) for tx, api in calls]
+        return [(tx, future.result()) for tx, future in futures]
 
     def format(self, currency, amount):
         return f"{amount:.{currency.decimal_places}f}"
@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import defaultdict, deque
+
+import requests
+
+_logger = logging.getLogger(__name__)
+
+
+class Recorder:
+    """ Records the Tabby API calls of this worker to a JSON lines file.
+
+    Each attempt of a call is written as one line with its method, endpoint,
+    merchant code, request body, response status, headers and body, error and
+    duration, and its time `t` in seconds since the recording started. Bodies
+    are redacted with the log policy rules, but not truncated.
+
+    Enabled by setting the `payment_tabby.record_path` system parameter; the
+    pid of the worker is appended to the path so that prefork workers never
+    write to the same file.
+    """
+
+    _recorders = {}
+    _recorders_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path):
+        """ Return the recorder of a path in this worker, or None if recording is disabled. """
+        if not path:
+            return None
+        path = f'{path}.{os.getpid()}'
+        recorder = cls._recorders.get(path)
+        if recorder is None:
+            with cls._recorders_lock:
+                recorder = cls._recorders.setdefault(path, cls(path))
+        return recorder
+
+    def record(self, method, endpoint, merchant_code, body, response, error, elapsed, log_policy):
+        """ Append one attempt of a call to the recording.
+
+        :param str body: The JSON-encoded request body, if any.
+        :param response: The response, or None if none was received.
+        :param error: The error raised by the attempt, if any.
+        :param float elapsed: The duration of the attempt, in seconds.
+        :param log_policy: The `LogPolicy` whose redaction rules apply.
+        """
+        if response is not None:
+            try:
+                response_body = response.json()
+            except ValueError:
+                response_body = response.text
+        else:
+            response_body = None
+        entry = {
+            't': round(time.monotonic() - self.started_at - elapsed, 6),
+            'method': method,
+            'endpoint': endpoint,
+            'merchant_code': merchant_code,
+            'request': log_policy.sanitize(json.loads(body), truncate=False) if body else None,
+            'status': response.status_code if response is not None else None,
+            'headers': {
+                name: response.headers[name] for name in ('Retry-After',) if name in response.headers
+            } if response is not None else {},
+            'response': log_policy.sanitize(response_body, truncate=False),
+            'error': ('timeout' if isinstance(error, requests.exceptions.Timeout) else 'connection')
+                     if error is not None and response is None else None,
+            'elapsed': round(elapsed, 6),
+        }
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            try:
+                with open(self.path, 'a', encoding='utf-8') as file:
+                    file.write(line + '\n')
+            except OSError:
+                _logger.exception('Tabby recorder. Failed to write to %s.', self.path)
+
+
+class Replayer:
+    """ Serves recorded Tabby API responses instead of calling the API.
+
+    The calls are matched on their method and endpoint, and each match gets
+    the next recorded response of that call in recording order; once they are
+    exhausted the last one is served again, as a payment keeps its final
+    status. Calls that were never recorded fail as if the API were unreachable.
+    Each response is delayed by its recorded duration times the time scale:
+    1 replays the recorded latencies, 0 answers at once.
+
+    Enabled by setting the `payment_tabby.replay_path` system parameter, and
+    optionally `payment_tabby.replay_time_scale`. The replay starts over when
+    the recording file changes, or on `rewind`.
+    """
+
+    _replayers = {}
+    _replayers_lock = threading.Lock()
+
+    def __init__(self, path, time_scale=1.0):
+        self.path = path
+        self.time_scale = time_scale
+        self.mtime = os.stat(path).st_mtime
+        with open(path, encoding='utf-8') as file:
+            self.entries = [json.loads(line) for line in file if line.strip()]
+        self.entries.sort(key=lambda entry: entry['t'])
+        self._lock = threading.Lock()
+        self.rewind()
+
+    def rewind(self):
+        """ Start serving the recording over from its first response. """
+        queues = defaultdict(deque)
+        for entry in self.entries:
+            queues[entry['method'], entry['endpoint']].append(entry)
+        with self._lock:
+            self._queues = queues
+            self._last = {}
+
+    @classmethod
+    def get(cls, path, time_scale=1.0):
+        """ Return the replayer of a recording in this worker, or None if replay is disabled. """
+        if not path:
+            return None
+        key = (path, time_scale)
+        try:
+            mtime = os.stat(path).st_mtime
+            replayer = cls._replayers.get(key)
+            if replayer is None or replayer.mtime != mtime:
+                with cls._replayers_lock:
+                    replayer = cls._replayers.get(key)
+                    if replayer is None or replayer.mtime != mtime:
+                        replayer = cls._replayers[key] = cls(path, time_scale)
+        except OSError:
+            _logger.exception('Tabby replayer. Cannot read the recording %s, replay disabled.', path)
+            return None
+        return replayer
+
+    def respond(self, method, endpoint, url):
+        """ Return the next recorded response of a call.
+
+        :return: The response.
+        :rtype: requests.Response
+        :raise requests.exceptions.RequestException: If the call was recorded
+            without a response, or never recorded.
+        """
+        key = (method, endpoint)
+        with self._lock:
+            queue = self._queues.get(key)
+            entry = queue.popleft() if queue else self._last.get(key)
+            if entry is not None:
+                self._last[key] = entry
+        if entry is None:
+            raise requests.exceptions.ConnectionError(f"No recorded response for {method} {endpoint}")
+
+        if self.time_scale and entry.get('elapsed'):
+            time.sleep(entry['elapsed'] * self.time_scale)
+        if entry.get('error') == 'timeout':
+            raise requests.exceptions.ReadTimeout(f"Recorded timeout of {method} {endpoint}")
+        if entry.get('status') is None:
+            raise requests.exceptions.ConnectionError(f"Recorded connection error of {method} {endpoint}")
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.url = url
+        response.headers.update(entry.get('headers') or {})
+        body = entry.get('response')
+        response._content = (body if isinstance(body, str) else json.dumps(body)).encode()
+        response.encoding = 'utf-8'
+        return response
@@ -0,0 +1,17 @@
+from odoo import api, models
+
+
+class ResPartner(models.Model):
+    _inherit = 'res.partner'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        partners = super().create(vals_list)
+        self.env['payment.tabby.contact'].sudo()._sync(partners)
+        return partners
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {'email', 'phone'} & vals.keys():
+            self.env['payment.tabby.contact'].sudo()._sync(self)
+        return res
@@ -0,0 +1,35 @@
+import hashlib
+
+from odoo import models
+
+
+class SaleOrder(models.Model):
+    _inherit = 'sale.order'
+
+    def _tabby_get_session_cache_key(self, lang):
+        """ Return a key that changes whenever the order, its lines or its partners change. """
+        self.ensure_one()
+        versions = [
+            self.write_date,
+            self.currency_id.id,
+            self.partner_id.write_date,
+            self.partner_shipping_id.write_date,
+            sorted((line.id, line.write_date) for line in self.order_line),
+            lang,
+        ]
+        return hashlib.sha1(repr(versions).encode()).hexdigest()
+
+    def _tabby_get_cached_session_data(self, key):
+        """ Return the cached session payload if it was built for this key and is still fresh. """
+        self.ensure_one()
+        return self.env['payment.tabby.session.cache'].sudo()._get(self, key)
+
+    def _tabby_set_cached_session_data(self, key, payload):
+        self.ensure_one()
+        self.env['payment.tabby.session.cache'].sudo()._set(self, key, payload)
+
+    def _action_confirm(self):
+        # The cached payloads hold the buyer's personal data; drop them once the order is placed.
+        res = super()._action_confirm()
+        self.env['payment.tabby.session.cache'].sudo()._clear(self)
+        return res
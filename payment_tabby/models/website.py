@@ -0,0 +1,12 @@
+from odoo import models
+
+
+class Website(models.Model):
+    _inherit = 'website'
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {'company_id', 'domain'} & vals.keys():
+            # payment.provider._tabby_get_storefront_data, _tabby_get_hostname
+            self.env.registry.clear_cache()
+        return res